@@ -3,9 +3,32 @@
 ##                                      ##
 ## Written by Juanma					##
 ##########################################
-import machine
+try:
+	import machine
+except ImportError:		# host side (CPython), decode_log() and format_log() of the log files
+	machine = None
 import sys
 import io
+import os
+import time
+try:
+	import ustruct as struct
+except ImportError:
+	import struct
+try:
+	from micropython import const
+except ImportError:
+	const = lambda x: x
+try:
+	from time import ticks_ms, ticks_diff, ticks_add
+except ImportError:		# ports without ticks_*(), same emulation as ts.ticks_ms()
+	import time
+	def ticks_ms():
+		return int(time.monotonic()*1000) & 0x3fffffff
+	def ticks_add(ticks, delta):
+		return (ticks+delta) & 0x3fffffff
+	def ticks_diff(ticks1, ticks2):
+		return ((ticks1-ticks2+0x20000000) & 0x3fffffff) - 0x20000000
 
 CRITICAL = const(50)
 ERROR    = const(40)
@@ -22,12 +45,21 @@ _level_dict = {
 	DEBUG: "DEBUG",
 }
 
+# Disabled calls cost one comparison: each logger caches its effective level
+# in _min, refreshed by setLevel() and basicConfig(). Records only keep the
+# message template and its args, they are formatted when a handler emits.
+# Hot call sites are written as
+#	if __debug__ and logger.isEnabledFor(DEBUG): logger.log(DEBUG, ...)
+# so the arguments are not even built when DEBUG is off, and the whole
+# statement is removed from the bytecode when compiled with optimization
+# (micropython.opt_level(1) before importing, or mpy-cross -O1).
 class Logger:
 	level = NOTSET
 	def __init__(self, name):
 		#print("New Logger [{}]".format(name))
 		self.name = name
 		self.handlers = None
+		self._min = self.level or _level	# effective level
 	def _level_str(self, level):
 		l = _level_dict.get(level)
 		if l is not None:
@@ -35,10 +67,11 @@ class Logger:
 		return "LVL%s" % level
 	def setLevel(self, level):
 		self.level = level
+		self._min = level or _level
 	def isEnabledFor(self, level):
-		return level >= (self.level or _level)
+		return level >= self._min
 	def log(self, level, msg, *args):
-		if level >= (self.level or _level):
+		if level >= self._min:
 			record = LogRecord(self.name, level, None, None, msg, args, None, None, None)
 			if self.handlers:
 				for hdlr in self.handlers:
@@ -70,6 +103,11 @@ class Logger:
 _level = INFO
 _loggers = {}
 _defaultformatter= None
+_clock = None		# object with datetime(ticks) to convert record ticks to wall clock, see setClock()
+
+def setClock(clock):	# ts.timestamp registers itself here, so records are timed from ticks instead of reading the RTC
+	global _clock
+	_clock = clock
 
 def getLogger(name=None):
 	global _defaultformatter, _loggers
@@ -98,6 +136,8 @@ def debug(msg, *args):
 def basicConfig(level=INFO, fmt=None, style="{", filename=None, stream=None):
 	global _level, _defaultformatter
 	_level = level
+	for l in _loggers.values():		# loggers without their own level follow the new one
+		l._min = l.level or _level
 	if filename:
 		h = FileHandler(filename)
 	else:
@@ -144,13 +184,336 @@ class FileHandler(Handler):
 		if self._f is None:
 			self._f = open(self.filename, self.mode)
 		self._f.write(self.formatter.format(record) + self.terminator)
+	def flush(self):
+		if self._f is not None:
+			self._f.flush()
+	def close(self):
+		if self._f is not None:
+			self._f.close()
+
+
+# Compact binary records: a tag byte and packed fields, big endian.
+#	_NAME		uint8 id, uint8 length, logger name
+#	_TEMPLATE	uint16 id, uint16 length, message template
+#	_RECORD		uint32 secs (Unix epoch), uint16 ms, uint8 level, uint8 name id,
+#				uint16 template id, uint8 number of args, then each arg as a type byte:
+#				"i" int32, "q" int64, "f" float32, "s" uint16 length + utf-8, "n" None, "t"/"F" bools
+# Names and templates are defined before their first use in a file, so every
+# file decodes on its own with decode_log().
+_UNIX     = 946684800 if time.gmtime(0)[0] == 2000 else 0	# secs from 1970 to the time.time() epoch of the port
+_NAME     = const(1)
+_TEMPLATE = const(2)
+_RECORD   = const(3)
+
+class BinaryEncoder:
+	def __init__(self):
+		self.reset()
+	def reset(self):	# forgets the definitions, for a new file
+		self._names = {}
+		self._templates = {}
+	def _id(self, table, tag, key, fmt):	# id of key, its definition is appended to out first if new
+		i = table.get(key)
+		if i is None:
+			i = len(table)
+			table[key] = i
+			b = key.encode() if type(key) is str else bytes(key)
+			self._out += struct.pack(fmt, tag, i, len(b))
+			self._out += b
+		return i
+	def encode(self, record, out):	# appends the record, and the definitions it needs, to the bytearray out
+		self._out = out
+		name = self._id(self._names, _NAME, record.name or "", "!BBB") & 0xff
+		tmpl = self._id(self._templates, _TEMPLATE, record.msg or "", "!BHH")
+		secs, ms = _clock.epoch_ms(record.ticks) if _clock else (int(time.time()), 0)
+		secs += _UNIX	# the files are read on hosts with any epoch
+		args = record.args or ()
+		out += struct.pack("!BIHBBHB", _RECORD, secs, ms, record.levelno, name, tmpl, len(args))
+		for a in args:
+			t = type(a)
+			if t is int and -0x80000000 <= a < 0x80000000:
+				out += struct.pack("!Bi", 105, a)
+			elif t is int:
+				out += struct.pack("!Bq", 113, a)
+			elif t is float:
+				out += struct.pack("!Bf", 102, a)
+			elif a is None:
+				out.append(110)
+			elif t is bool:
+				out.append(116 if a else 70)
+			else:
+				b = a.encode() if t is str else bytes(a) if t in (bytes, bytearray) else str(a).encode()
+				out += struct.pack("!BH", 115, len(b))
+				out += b
+		self._out = None
+		return out
+
+def _unpack_args(buf, i, n):
+	args = []
+	for _ in range(n):
+		t = buf[i]
+		i += 1
+		if t == 105 or t == 113 or t == 102:
+			fmt = "!i" if t == 105 else "!q" if t == 113 else "!f"
+			args.append(struct.unpack_from(fmt, buf, i)[0])
+			i += struct.calcsize(fmt)
+		elif t == 115:
+			l = struct.unpack_from("!H", buf, i)[0]
+			args.append(bytes(buf[i+2:i+2+l]).decode())
+			i += 2 + l
+		else:
+			args.append(None if t == 110 else t == 116)
+	return args, i
+
+def decode_log(data):	# yields (secs, ms, level, name, message) of the binary records in data (bytes or a file name), runs on the host too
+	if type(data) is str:
+		with open(data, "rb") as f:
+			data = f.read()
+	names = {}
+	templates = {}
+	i = 0
+	while i < len(data):
+		tag = data[i]
+		if tag == _NAME or tag == _TEMPLATE:
+			fmt = "!BBB" if tag == _NAME else "!BHH"
+			_, k, l = struct.unpack_from(fmt, data, i)
+			i += struct.calcsize(fmt)
+			(names if tag == _NAME else templates)[k] = bytes(data[i:i+l]).decode()
+			i += l
+		elif tag == _RECORD:
+			_, secs, ms, level, name, tmpl, n = struct.unpack_from("!BIHBBHB", data, i)
+			args, i = _unpack_args(data, i + 12, n)
+			msg = templates.get(tmpl, "?")
+			try:
+				msg = msg.format(*args) if "{" in msg or "%" not in msg else msg % tuple(args)
+			except Exception:
+				msg = "{} {}".format(msg, args)
+			yield secs, ms, level, names.get(name, "?"), msg
+		else:
+			raise ValueError("bad record tag {} at {}".format(tag, i))
+
+def format_log(data):	# decode_log() as text lines
+	for secs, ms, level, name, msg in decode_log(data):
+		t = time.localtime(secs - _UNIX)
+		yield "{0}-{1:02}-{2:02} {3:02}:{4:02}:{5:02}.{6:03} {7}:{8}:{9}".format(t[0], t[1], t[2], t[3], t[4], t[5], ms,
+			_level_dict.get(level, "LVL%s" % level), name, msg)
+
+
+class RotatingFileHandler(Handler):
+	# Writes to filename until it would exceed maxBytes, then renames it to
+	# filename.1, the previous filename.1 to filename.2 and so on, keeping
+	# backupCount of them. With binary=True the records are written with
+	# BinaryEncoder, several times smaller than the text lines, and are read
+	# back with decode_log()/format_log().
+	def __init__(self, filename, maxBytes=16384, backupCount=2, binary=False):
+		super().__init__()
+		self.terminator = "\n"
+		self.filename = filename
+		self.maxBytes = maxBytes
+		self.backupCount = backupCount
+		self.binary = binary
+		self._enc = BinaryEncoder() if binary else None
+		self._buf = bytearray()		# binary record being encoded
+		self._f = None
+		self._size = 0
+	def _open(self):
+		self._f = open(self.filename, "ab" if self.binary else "a")
+		try:
+			self._size = os.stat(self.filename)[6]
+		except OSError:
+			self._size = 0
+	def emit(self, record):
+		if self._f is None:
+			self._open()
+		if self._enc:
+			self._buf[:] = b""
+			data = self._enc.encode(record, self._buf)
+		else:
+			data = self.formatter.format(record) + self.terminator
+		if self._size and self._size + len(data) > self.maxBytes:
+			self.doRollover()
+			if self._enc:	# the new file needs the definitions
+				self._buf[:] = b""
+				data = self._enc.encode(record, self._buf)
+		self._f.write(data)
+		self._size += len(data)
+	def doRollover(self):
+		if self._f is not None:
+			self._f.close()
+		try:
+			os.remove("{}.{}".format(self.filename, self.backupCount) if self.backupCount else self.filename)
+		except OSError:
+			pass
+		for i in range(self.backupCount - 1, 0, -1):
+			try:
+				os.rename("{}.{}".format(self.filename, i), "{}.{}".format(self.filename, i + 1))
+			except OSError:
+				pass
+		if self.backupCount:
+			try:
+				os.rename(self.filename, self.filename + ".1")
+			except OSError:
+				pass
+		if self._enc:
+			self._enc.reset()
+		self._open()
+	def flush(self):
+		if self._f is not None:
+			self._f.flush()
 	def close(self):
 		if self._f is not None:
 			self._f.close()
+			self._f = None
+
+
+class MemoryHandler(Handler):
+	# Keeps the last capacity records in a ring of preallocated LogRecords, the
+	# fields of each record are copied into a slot, so nothing is allocated per
+	# record. The ring is written to target, oldest first, when flushSize records
+	# are buffered, when a record of flushLevel or above arrives (with the records
+	# that led to it) or when flush() is called. Without target, or while
+	# flushSize is not reached, the oldest records are overwritten.
+	def __init__(self, capacity=32, target=None, flushLevel=ERROR, flushSize=None):
+		super().__init__()
+		self.target = target
+		self.flushLevel = flushLevel
+		self.flushSize = flushSize	# None flushes only on flushLevel or flush()
+		self._ring = [LogRecord(None, NOTSET, None, None, None, None, None) for _ in range(capacity)]
+		self._head = 0		# oldest record
+		self._n = 0			# records buffered
+		self.dropped = 0	# records overwritten before being flushed
+	def setTarget(self, target):
+		self.target = target
+	def emit(self, record):
+		ring = self._ring
+		if self._n == len(ring):	# full, overwrites the oldest
+			ring[self._head].assign(record)
+			self._head = (self._head + 1) % len(ring)
+			self.dropped += 1
+		else:
+			ring[(self._head + self._n) % len(ring)].assign(record)
+			self._n += 1
+		if record.levelno >= self.flushLevel or (self.flushSize and self._n >= self.flushSize):
+			self.flush()
+	def flush(self):
+		t = self.target
+		if t is None:
+			return
+		ring = self._ring
+		while self._n:
+			r = ring[self._head]
+			self._head = (self._head + 1) % len(ring)
+			self._n -= 1
+			t.emit(r)
+			r.args = None	# releases the arguments
+		if hasattr(t, "flush"):
+			t.flush()
+	def close(self):
+		self.flush()
+
+
+class MQTTHandler(MemoryHandler):
+	# Ships records over MQTT: they are buffered in the MemoryHandler ring and
+	# sent as one message per batch, of BinaryEncoder records (text lines if
+	# binary=False) up to max_bytes. publish(topic, msg) is given by the owner,
+	# e.g. Device.set_remote_log(), and returns False when the link is down or
+	# busy: the batch is then dropped, sensor publishing never waits for logs.
+	# rates limits each level to that many records per second (None unlimited),
+	# and records logged while publishing (by MQTT_slim or the publish error
+	# path) are dropped so a log can't trigger itself.
+	RATES = {DEBUG: 2, INFO: 5, WARNING: 10}
+	def __init__(self, publish, topic, level=INFO, capacity=32, batch=16, interval=5000,
+			max_bytes=1024, rates=None, binary=True):
+		super().__init__(capacity, None, ERROR, batch)
+		self._publish = publish
+		self.topic = topic
+		self.level = level
+		self.interval = interval	# ms between batches of less than flushSize records
+		self.binary = binary
+		self._enc = BinaryEncoder() if binary else None
+		self._out = bytearray(max_bytes)	# message being built
+		self._rec = bytearray()		# record being encoded
+		self._rates = {}	# level -> [records/s, credit in 1/1000 records, ticks of the last refill]
+		for l, r in (self.RATES if rates is None else rates).items():
+			if r:
+				self._rates[l] = [r, r * 1000, ticks_ms()]
+		self._t = ticks_ms()	# last batch sent
+		self._busy = False		# publishing, the records logged meanwhile are dropped
+		self.sent = 0			# records shipped
+		self.limited = 0		# records dropped by the rates
+		self.lost = 0			# records dropped by backpressure, recursion or overflow
+	def emit(self, record):
+		if self._busy:
+			self.lost += 1
+			return
+		if record.levelno < self.level:
+			return
+		r = self._rates.get(record.levelno)
+		if r:	# credit of 1000 per record, refilled at the level rate, 1s of burst
+			now = ticks_ms()
+			r[1] = min(r[0] * 1000, r[1] + ticks_diff(now, r[2]) * r[0])
+			r[2] = now
+			if r[1] < 1000:
+				self.limited += 1
+				return
+			r[1] -= 1000
+		d = self.dropped
+		super().emit(record)
+		self.lost += self.dropped - d
+		self.dropped = d
+	def poll(self):	# sends the buffered records once interval has elapsed, called from the main loop
+		if self._n and ticks_diff(ticks_ms(), self._t) >= self.interval:
+			self.flush()
+	def flush(self):
+		if self._busy or not self._n:
+			return
+		self._busy = True
+		try:
+			ring = self._ring
+			while self._n:
+				out = self._out
+				i = 0
+				k = 0
+				if self._enc:
+					self._enc.reset()	# each message decodes on its own
+				while k < self._n:
+					r = ring[(self._head + k) % len(ring)]
+					if self._enc:
+						self._rec[:] = b""
+						b = self._enc.encode(r, self._rec)
+					else:
+						b = (self.formatter.format(r) + "\n").encode()
+					if i + len(b) > len(out):
+						if not k:	# larger than a message, skipped
+							k = 1
+							self.lost += 1
+						break
+					out[i:i + len(b)] = b
+					i += len(b)
+					k += 1
+				ok = not i or self._publish(self.topic, memoryview(out)[:i])
+				for _ in range(k):
+					ring[self._head].args = None
+					self._head = (self._head + 1) % len(ring)
+				self._n -= k
+				if not i:	# only the skipped record, already counted as lost
+					continue
+				if ok:
+					self.sent += k
+				else:	# backpressure, the rest is dropped too
+					self.lost += k + self._n
+					self._head = (self._head + self._n) % len(ring)
+					self._n = 0
+		finally:
+			self._busy = False
+			self._t = ticks_ms()
 
 
 class Formatter:
-	converter = machine.RTC().datetime
+	# The template is compiled once into _parts: literal strings and (field, spec)
+	# pairs, field being a record attribute name or a method computing it, spec
+	# the "%spec" or "{!conv:spec}" string applied to its value, or None for str().
+	# Templates with other fields are formatted by _fallback() with all of them.
+	converter = machine.RTC().datetime if machine else None
 	def __init__(self, fmt=None, datefmt=None, style="{"):
 		if style=="%":
 			self.fmt = fmt or "%(message)s"
@@ -160,50 +523,139 @@ class Formatter:
 			raise ValueError("Style must be one of: %, {")
 		self.style = style
 		self.datefmt = datefmt
+		self._sec_t = None		# ticks at the start of the second in _sec_s
+		self._sec_s = None		# "YYYY-MM-DD HH:MM:SS" of that second
+		self._names = []		# fields used by the template
+		self._pct = style == "%"
+		try:
+			self._parts = self._compile_pct(self.fmt) if self._pct else self._compile_brace(self.fmt)
+		except (KeyError, ValueError):	# fields that are not record attributes, or a malformed template
+			self._parts = None
+		self._message_only = self.fmt in ("{message}", "%(message)s")
+	def _field(self, name, spec):
+		get = {"message": self._message, "asctime": self._asctime, "created": self._created, "msecs": self._msecs}.get(name, name)
+		if get is name and name not in LogRecord.__slots__:
+			raise KeyError(name)
+		self._names.append(name)
+		return (get, spec)
+	def _compile_brace(self, fmt):
+		parts = []
+		lit = ""
+		i = 0
+		n = len(fmt)
+		while i < n:
+			c = fmt[i]
+			if (c == "{" or c == "}") and fmt[i+1:i+2] == c:	# escaped brace
+				lit += c
+				i += 2
+			elif c == "{":
+				j = fmt.index("}", i)
+				name, _, spec = fmt[i+1:j].partition(":")
+				name, _, conv = name.partition("!")
+				if conv not in ("", "r", "s"):
+					raise ValueError(conv)
+				if lit:
+					parts.append(lit)
+					lit = ""
+				parts.append(self._field(name, "{" + ("!" + conv if conv else "") + (":" + spec if spec else "") + "}" if spec or conv else None))
+				i = j + 1
+			else:
+				lit += c
+				i += 1
+		if lit:
+			parts.append(lit)
+		return parts
+	def _compile_pct(self, fmt):
+		parts = []
+		lit = ""
+		i = 0
+		n = len(fmt)
+		while i < n:
+			c = fmt[i]
+			if c == "%" and fmt[i+1:i+2] == "%":
+				lit += c
+				i += 2
+			elif c == "%" and fmt[i+1:i+2] == "(":
+				j = fmt.index(")", i)
+				k = j + 1
+				while fmt[k] not in "diouxXeEfFgGcrsa":	# flags, width and precision up to the conversion
+					k += 1
+				if lit:
+					parts.append(lit)
+					lit = ""
+				spec = fmt[j+1:k+1]
+				parts.append(self._field(fmt[i+2:j], None if spec == "s" else "%" + spec))
+				i = k + 1
+			else:
+				lit += c
+				i += 1
+		if lit:
+			parts.append(lit)
+		return parts
 	def usesTime(self):
-		if self.style == "%":
-			return "%(asctime)" in self.fmt
-		elif self.style == "{":
-			return "{asctime" in self.fmt
+		return "asctime" in (self._names if self._parts is not None else self.fmt)
 	def format(self, record):
+		if self._message_only:
+			return self._message(record)
+		if self._parts is None:
+			return self._fallback(record)
+		out = []
+		pct = self._pct
+		for p in self._parts:
+			if type(p) is str:
+				out.append(p)
+				continue
+			get, spec = p
+			v = getattr(record, get) if type(get) is str else get(record)
+			out.append(str(v) if spec is None else spec % v if pct else spec.format(v))
+		return "".join(out)
+	def _fallback(self, record):	# the template formatted with all the record attributes, as str.format() or %
+		self._message(record)
+		self._asctime(record)
+		fields = {k: getattr(record, k) for k in LogRecord.__slots__}
+		try:
+			return self.fmt % fields if self._pct else self.fmt.format(**fields)
+		except Exception as e:
+			sys.print_exception(e)
+			print("format request: {}.format(**{})", self.fmt, fields)
+			return self.fmt
+	def _message(self, record):
 		# The message attribute of the record is computed using msg % args.
-		if self.style == "%":
-			record.message = record.msg % record.args
-		else:
+		m = record.msg
+		if record.args:
 			try:
-				record.message = record.msg.format(*record.args)
+				m = m % record.args if self.style == "%" else m.format(*record.args)
 			except Exception as e:
 				sys.print_exception(e)
 				print("record.msg==[{}], record.args==[{}]", record.msg, record.args)
-			
-		# If the formatting string contains '(asctime)', formatTime() is called to
-		# format the event time.
-		if self.usesTime():
-			record.asctime = self.formatTime(record, self.datefmt)
 		# If there is exception information, it is formatted using formatException()
 		# and appended to the message. The formatted exception information is cached
 		# in attribute exc_text.
 		if record.exc_info is not None:
 			record.exc_text += self.formatException(record.exc_info)
-			record.message += "\n" + record.exc_text
-		# The record’s attribute dictionary is used as the operand to a string
-		# formatting operation.
-		if self.style == "%":
-			return self.fmt % record.__dict__
-		elif self.style == "{":
-			try:
-				return self.fmt.format(**record.__dict__)
-			except Exception as e:
-				sys.print_exception(e)
-				print("format request: {}.format(**{})", self.fmt, record.__dict__)
-				
-		else:
-			raise ValueError("Style {0} is not supported by logging.".format(self.style))
+			m += "\n" + record.exc_text
+		record.message = m
+		return m
+	def _asctime(self, record):	# formatTime() with the date and time part cached for the current second
+		if record.asctime is None:
+			d = None if self._sec_t is None else ticks_diff(record.ticks, self._sec_t)
+			if d is None or d < 0 or d >= 1000 or not _clock:
+				t = record.time()
+				self._sec_t = ticks_add(record.ticks, -(t[7] // 1000))
+				self._sec_s = "{0}-{1:02}-{2:02} {4:02}:{5:02}:{6:02}".format(*t)
+				d = t[7] // 1000
+			record.asctime = "{}.{:06}".format(self._sec_s, d * 1000)
+		return record.asctime
+	def _created(self, record):
+		return record.time()
+	def _msecs(self, record):
+		record.time()
+		return record.msecs
 	def formatTime(self, record, datefmt=None):
 		assert datefmt is None  # datefmt is not supported
 		#ct = utime.localtime(record.created)
 		#return "{0}-{1}-{2} {4}:{5}:{6}.{7:5.4}".format(*ct)
-		return "{0}-{1:02}-{2:02} {4:02}:{5:02}:{6:02}.{7:06}".format(*record.created)
+		return "{0}-{1:02}-{2:02} {4:02}:{5:02}:{6:02}.{7:06}".format(*record.time())
 	def formatException(self, exc_info):
 		raise NotImplementedError()
 	def formatStack(self, stack_info):
@@ -211,14 +663,20 @@ class Formatter:
 
 root = getLogger()
 
+def _rtc_datetime():	# RTC.datetime() format of now, for records timed without a clock
+	if machine:
+		return machine.RTC().datetime()
+	import time
+	t = time.localtime()
+	return (t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0)
+
 class LogRecord:
+	__slots__ = ("ticks", "created", "msecs", "name", "levelno", "levelname", "pathname", "lineno",
+		"msg", "args", "exc_info", "exc_text", "func", "sinfo", "message", "asctime")
 	def __init__(self, name, level, pathname, lineno, msg, args, exc_info, func=None, sinfo=None):
-		#ct = utime.time()
-		#self.created = ct
-		ct=machine.RTC().datetime()
-		self.created = machine.RTC().datetime()
-		#self.msecs = (ct - int(ct)) * 1000
-		self.msecs= ct[7]
+		self.ticks = ticks_ms()		# the only clock read, created and msecs are computed by time() when formatted
+		self.created = None
+		self.msecs = None
 		self.name = name
 		self.levelno = level
 		self.levelname = _level_dict.get(level, None)
@@ -227,5 +685,38 @@ class LogRecord:
 		self.msg = msg
 		self.args = args
 		self.exc_info = exc_info
+		self.exc_text = ""
 		self.func = func
 		self.sinfo = sinfo
+		self.message = None		# msg formatted with args, set by Formatter.format()
+		self.asctime = None
+	def assign(self, r):	# copies the fields of r, so MemoryHandler reuses its records
+		self.ticks = r.ticks
+		self.created = r.created
+		self.msecs = r.msecs
+		self.name = r.name
+		self.levelno = r.levelno
+		self.levelname = r.levelname
+		self.pathname = r.pathname
+		self.lineno = r.lineno
+		self.msg = r.msg
+		self.args = r.args
+		self.exc_info = r.exc_info
+		self.exc_text = r.exc_text
+		self.func = r.func
+		self.sinfo = r.sinfo
+		self.message = r.message
+		self.asctime = r.asctime
+	def time(self):		# RTC.datetime() format of the record time
+		if self.created is None:
+			self.created = _clock.datetime(self.ticks) if _clock else _rtc_datetime()
+			self.msecs = self.created[7]
+		return self.created
+
+def bench_format(fmt="{asctime} {levelname}:{name}:{message}", style="{", n=1000):	# records created and formatted per second, run it on the device
+	f = Formatter(fmt, style=style)
+	msg = "value {} of {}" if style == "{" else "value %s of %s"
+	t = ticks_ms()
+	for i in range(n):
+		f.format(LogRecord("bench", INFO, None, None, msg, (i, "bench"), None))
+	return n * 1000 // max(1, ticks_diff(ticks_ms(), t))
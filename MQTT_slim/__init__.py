@@ -12,16 +12,43 @@ logger = logging.getLogger(__name__)
 logger.log(logging.DEBUG,"Module [{}] loading",__name__)
 
 import socket
-import ustruct as struct
-from ubinascii import hexlify
+from msgs import BufferFull	# raised by publish_msg() like by the msgs codecs
+try:
+	import ustruct as struct
+	from ubinascii import hexlify
+except ImportError:		# CPython
+	import struct
+	from binascii import hexlify
+from array import array
+import errno
+try:
+	from micropython import const
+except ImportError:
+	const = lambda x: x
+try:
+	from time import ticks_ms, ticks_diff
+except ImportError:		# CPython, same emulation as ts.ticks_ms()
+	import time
+	def ticks_ms():
+		return int(time.monotonic()*1000) & 0x3fffffff
+	def ticks_diff(ticks1, ticks2):
+		return ((ticks1-ticks2+0x20000000) & 0x3fffffff) - 0x20000000
+
+def _b(s):		# str topics and messages are encoded to be copied into the packet buffer
+	return s.encode() if type(s) is str else s
 
 class MQTTException(Exception):
 	logger.log(logging.DEBUG,"MQTTException [{}] ",Exception)
 	pass
 
+_WAIT_PUBACK	= const(1)	# QoS 1 PUBLISH sent
+_WAIT_PUBREC	= const(2)	# QoS 2 PUBLISH sent
+_WAIT_PUBCOMP	= const(3)	# QoS 2 PUBREL sent
+
 class MQTTClient:
 	def __init__(self, client_id, server, port=0, user=None, password=None,
-				 keepalive=0, ssl=False, ssl_params={}):
+				 keepalive=0, ssl=False, ssl_params={}, inflight=8, ack_timeout=5000, bufsize=256,
+				 rbufsize=256, copy_msg=False):
 		if port == 0:
 			port = 8883 if ssl else 1883
 		self.client_id = client_id
@@ -39,14 +66,75 @@ class MQTTClient:
 		self.lw_msg = None
 		self.lw_qos = 0
 		self.lw_retain = False
-	def _send_str(self, s):
-		self.sock.write(struct.pack("!H", len(s)))
-		self.sock.write(s)
-	def _recv_len(self):
+		self.ack_timeout = ack_timeout		# ms before an unacknowledged PUBLISH (resent with DUP) or PUBREL is resent
+		self._pids = array("H", [0] * inflight)	# packet id of each outbound in-flight slot, 0 if free
+		self._state = bytearray(inflight)		# _WAIT_PUBACK, _WAIT_PUBREC or _WAIT_PUBCOMP of each slot
+		self._sent = array("l", [0] * inflight)	# ticks_ms() of the last transmission of each slot
+		self._pend = [None] * inflight			# (topic, msg, retain, callback) of each slot, kept for retransmission
+		self._ninflight = 0
+		self._rx_pids = array("H", [0] * inflight)	# inbound QoS 2 packet ids delivered and waiting for their PUBREL
+		self._rx_next = 0						# next _rx_pids slot to reuse when all are taken
+		self._buf = bytearray(bufsize)			# outgoing packets are assembled here and sent with a single write
+		self._rbuf = bytearray(rbufsize)		# incoming packets are read here with readinto()
+		self._rmv = memoryview(self._rbuf)
+		self.copy_msg = copy_msg				# callbacks get bytes copies instead of memoryviews of _rbuf
+		self._last_tx = 0						# ticks_ms() of the last packet sent
+		self._last_rx = 0						# ticks_ms() of the last packet received
+		self._ping_t = None						# ticks_ms() of the PINGREQ waiting for its PINGRESP
+		self.rtt = None							# smoothed broker round trip in ms, from PINGRESP and PUBACK/PUBCOMP
+	def _next_pid(self):
+		while 1:
+			self.pid = self.pid % 65535 + 1	# packet ids are 16 bit and never 0
+			if self.pid not in self._pids:	# skips ids still in flight
+				return self.pid
+	# Packet encoder: _frame() puts the fixed header at the start of self._buf
+	# and the _put*() methods append the fields, returning the next position.
+	# _send() writes the whole packet at once. Data that does not fit in the
+	# buffer is streamed: the buffered part and the data are written directly.
+	def _frame(self, op, sz, i=0):	# fixed header of a packet with sz remaining length, at i to append packets
+		buf = self._buf
+		if i + 5 > len(buf):
+			self.sock.write(buf, i)
+			i = 0
+		buf[i] = op
+		i += 1
+		while sz > 0x7f:
+			buf[i] = (sz & 0x7f) | 0x80
+			sz >>= 7
+			i += 1
+		buf[i] = sz
+		return i + 1
+	def _put(self, i, data):
+		n = len(data)
+		if i + n > len(self._buf):
+			if i:
+				self.sock.write(self._buf, i)
+			self.sock.write(data)
+			return 0
+		self._buf[i:i + n] = data
+		return i + n
+	def _put_u16(self, i, n):
+		if i + 2 > len(self._buf):
+			self.sock.write(self._buf, i)
+			i = 0
+		self._buf[i] = n >> 8
+		self._buf[i + 1] = n & 0xff
+		return i + 2
+	def _put_str(self, i, s):	# MQTT string: 16 bit length + data
+		return self._put(self._put_u16(i, len(s)), s)
+	def _send(self, i):
+		if i:
+			self.sock.write(self._buf, i)
+		self._last_tx = ticks_ms()
+	def _recv(self, i, n):	# reads exactly n bytes into the receive buffer at i
+		if self.sock.readinto(self._rmv[i:i + n]) != n:
+			raise OSError(-1)
+	def _recv_len(self):	# remaining length, read straight into the receive buffer
 		n = 0
 		sh = 0
 		while 1:
-			b = self.sock.read(1)[0]
+			self._recv(1, 1)
+			b = self._rbuf[1]
 			n |= (b & 0x7f) << sh
 			if not b & 0x80:
 				return n
@@ -60,146 +148,316 @@ class MQTTClient:
 		self.lw_msg = msg
 		self.lw_qos = qos
 		self.lw_retain = retain
+	# With clean_session=False the broker keeps the subscriptions and the
+	# in-flight messages are resent (with DUP) after the CONNACK, so
+	# connect() can be called again after an OSError to resume the session.
 	def connect(self, clean_session=True):
+		if self.sock:
+			try:
+				self.sock.close()
+			except OSError:
+				pass
 		self.sock = socket.socket()
+		self.sock.settimeout(self.ack_timeout / 1000)	# a dead broker fails the connection instead of blocking it
 		addr = socket.getaddrinfo(self.server, self.port)[0][-1]
 		self.sock.connect(addr)
 		if self.ssl:
 			import ussl
 			self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
-		premsg = bytearray(b"\x10\0\0\0\0\0")
-		msg = bytearray(b"\x04MQTT\x04\x02\0\0")
-
-		sz = 10 + 2 + len(self.client_id)
-		msg[6] = clean_session << 1
+		client_id = _b(self.client_id)
+		sz = 10 + 2 + len(client_id)
+		flags = clean_session << 1
 		if self.user is not None:
-			sz += 2 + len(self.user) + 2 + len(self.pswd)
-			msg[6] |= 0xC0
+			user = _b(self.user)
+			pswd = _b(self.pswd)
+			sz += 2 + len(user) + 2 + len(pswd)
+			flags |= 0xC0
 		if self.keepalive:
 			assert self.keepalive < 65536
-			msg[7] |= self.keepalive >> 8
-			msg[8] |= self.keepalive & 0x00FF
 		if self.lw_topic:
-			sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-			msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-			msg[6] |= self.lw_retain << 5
-		i = 1
-		while sz > 0x7f:
-			premsg[i] = (sz & 0x7f) | 0x80
-			sz >>= 7
-			i += 1
-		premsg[i] = sz
-		self.sock.write(premsg, i + 2)
-		self.sock.write(msg)
-		#print(hex(len(msg)), hexlify(msg, ":"))
-		self._send_str(self.client_id)
+			lw_topic = _b(self.lw_topic)
+			lw_msg = _b(self.lw_msg)
+			sz += 2 + len(lw_topic) + 2 + len(lw_msg)
+			flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+			flags |= self.lw_retain << 5
+		i = self._frame(0x10, sz)
+		i = self._put(i, b"\0\x04MQTT\x04")
+		i = self._put(i, bytes((flags,)))
+		i = self._put_u16(i, self.keepalive)
+		i = self._put_str(i, client_id)
 		if self.lw_topic:
-			self._send_str(self.lw_topic)
-			self._send_str(self.lw_msg)
+			i = self._put_str(i, lw_topic)
+			i = self._put_str(i, lw_msg)
 		if self.user is not None:
-			self._send_str(self.user)
-			self._send_str(self.pswd)
+			i = self._put_str(i, user)
+			i = self._put_str(i, pswd)
+		self._send(i)
 		resp = self.sock.read(4)
+		self.sock.setblocking(True)
 		assert resp[0] == 0x20 and resp[1] == 0x02
 		if resp[3] != 0:
 			raise MQTTException(resp[3])
+		if clean_session:	# the broker dropped the session, so do the in-flight messages
+			for i in range(len(self._pids)):
+				self._pids[i] = 0
+				self._state[i] = 0
+				self._pend[i] = None
+				self._rx_pids[i] = 0
+			self._ninflight = 0
+		else:
+			self._retransmit(True)
+		self._last_rx = ticks_ms()
+		self._ping_t = None
 		return resp[2] & 1
 	def disconnect(self):
 		self.sock.write(b"\xe0\0")
 		self.sock.close()
 	def ping(self):
-		self.sock.write(b"\xc0\0")
-	def publish(self, topic, msg, retain=False, qos=0):
-		pkt = bytearray(b"\x30\0\0\0")
-		pkt[0] |= qos << 1 | retain
+		self._send(self._frame(0xc0, 0))
+		if self._ping_t is None:
+			self._ping_t = self._last_tx
+	# Keepalive: any packet sent or received proves the link, so a PINGREQ
+	# is only sent once no packet has gone out or come in for half the
+	# keepalive period. A PINGRESP later than ack_timeout raises
+	# OSError(ETIMEDOUT), which check_msg() passes on to the caller.
+	def check_keepalive(self):
+		if not self.keepalive:
+			return
+		now = ticks_ms()
+		if self._ping_t is not None:
+			if ticks_diff(now, self._ping_t) >= self.ack_timeout:
+				self._ping_t = None
+				raise OSError(errno.ETIMEDOUT)
+		elif ticks_diff(now, self._last_tx) >= self.keepalive * 500 or ticks_diff(now, self._last_rx) >= self.keepalive * 500:
+			self.ping()
+	def ping_in(self):	# ms until check_keepalive() has something to do, None without keepalive
+		if not self.keepalive:
+			return None
+		now = ticks_ms()
+		if self._ping_t is not None:
+			return max(0, self.ack_timeout - ticks_diff(now, self._ping_t))
+		return max(0, self.keepalive * 500 - max(ticks_diff(now, self._last_tx), ticks_diff(now, self._last_rx)))
+	def _rtt(self, t):	# adds a round trip sample measured from ticks_ms() t
+		t = ticks_diff(ticks_ms(), t)
+		self.rtt = t if self.rtt is None else self.rtt + (t - self.rtt) // 8
+	# QoS 1 and 2 messages are pipelined: publish() returns the packet id as soon
+	# as the message is sent, and the PUBACK (QoS 1) or PUBREC/PUBCOMP (QoS 2)
+	# are matched later by wait_msg(), which calls callback(pid) on completion.
+	# Blocks only while the in-flight window is full.
+	def publish(self, topic, msg, retain=False, qos=0, callback=None):
+		if qos == 0:
+			self._publish(topic, msg, retain, 0, 0)
+			return None
+		assert qos <= 2
+		slot = self._free_slot()
+		pid = self._next_pid()
+		self._pids[slot] = pid
+		self._state[slot] = _WAIT_PUBACK if qos == 1 else _WAIT_PUBREC
+		self._pend[slot] = (topic, msg, retain, callback)
+		self._sent[slot] = ticks_ms()
+		self._ninflight += 1
+		self._publish(topic, msg, retain, qos, pid)
+		return pid
+	def _free_slot(self):	# waits for a PUBACK while the in-flight window is full
+		while 1:
+			for i in range(len(self._pids)):
+				if not self._pids[i]:
+					return i
+			self._wait_ack()
+	def _retransmit(self, force=False):	# resends the PUBLISH (with DUP) or PUBREL not acknowledged within ack_timeout, or all of them
+		if not self._ninflight:
+			return
+		now = ticks_ms()
+		for i in range(len(self._pids)):
+			if self._pids[i] and (force or ticks_diff(now, self._sent[i]) >= self.ack_timeout):
+				if self._state[i] == _WAIT_PUBCOMP:
+					self._send_ack(0x62, self._pids[i])
+				else:
+					topic, msg, retain, cb = self._pend[i]
+					self._publish(topic, msg, retain, self._state[i], self._pids[i], dup=True)	# _WAIT_PUBACK/_WAIT_PUBREC are the qos
+				self._sent[i] = now
+	def _slot(self, pid, state):	# in-flight slot of pid waiting in state, -1 if none (late or duplicated ack)
+		for i in range(len(self._pids)):
+			if self._pids[i] == pid and self._state[i] == state:
+				return i
+		return -1
+	def _done(self, i):	# frees the in-flight slot i and reports the completion
+		pid = self._pids[i]
+		cb = self._pend[i][3]
+		self._pids[i] = 0
+		self._state[i] = 0
+		self._pend[i] = None
+		self._ninflight -= 1
+		if cb:
+			cb(pid)
+	def _send_ack(self, op, pid):	# PUBACK, PUBREC, PUBREL or PUBCOMP
+		self._send(self._put_u16(self._frame(op, 2), pid))
+	def _ack(self, op, pid):	# processes an inbound PUBACK, PUBREC, PUBREL or PUBCOMP
+		if op == 0x40:		# PUBACK
+			i = self._slot(pid, _WAIT_PUBACK)
+			if i >= 0:
+				self._rtt(self._sent[i])
+				self._done(i)
+		elif op == 0x50:	# PUBREC, the broker owns the message now
+			i = self._slot(pid, _WAIT_PUBREC)
+			if i >= 0:
+				self._state[i] = _WAIT_PUBCOMP
+				self._pend[i] = (None, None, None, self._pend[i][3])	# releases the message, only the PUBREL may be resent
+				self._sent[i] = ticks_ms()
+			self._send_ack(0x62, pid)	# PUBREL, also answers a duplicated PUBREC
+		elif op == 0x70:	# PUBCOMP
+			i = self._slot(pid, _WAIT_PUBCOMP)
+			if i >= 0:
+				self._rtt(self._sent[i])
+				self._done(i)
+		elif op == 0x62:	# PUBREL of an inbound QoS 2 message
+			for i in range(len(self._rx_pids)):
+				if self._rx_pids[i] == pid:
+					self._rx_pids[i] = 0
+			self._send_ack(0x70, pid)	# PUBCOMP
+	def _rx_qos2(self, pid):	# True if the inbound QoS 2 message pid is new and must be delivered
+		if pid in self._rx_pids:	# redelivery before our PUBREC reached the broker
+			return False
+		rx = self._rx_pids
+		for i in range(len(rx)):
+			if not rx[i]:
+				rx[i] = pid
+				return True
+		rx[self._rx_next] = pid		# table full, forgets the oldest slot
+		self._rx_next = (self._rx_next + 1) % len(rx)
+		return True
+	def inflight(self):	# number of QoS 1 and 2 messages waiting for their acknowledgements
+		return self._ninflight
+	def wait_inflight(self):	# blocks until every in-flight message is acknowledged
+		while self._ninflight:
+			self._wait_ack()
+	def _wait_ack(self):	# processes one incoming packet, waiting up to ack_timeout, and resends the overdue messages
+		self._retransmit()
+		self.sock.settimeout(self.ack_timeout / 1000)	# wait_msg() restores blocking mode after the first byte
+		try:
+			self.wait_msg()
+		except OSError as e:
+			if e.args[0] not in (errno.ETIMEDOUT, errno.EAGAIN):
+				raise
+	def _publish(self, topic, msg, retain, qos, pid, dup=False):
+		topic = _b(topic)
+		msg = _b(msg)
 		sz = 2 + len(topic) + len(msg)
 		if qos > 0:
 			sz += 2
 		assert sz < 2097152
-		i = 1
-		while sz > 0x7f:
-			pkt[i] = (sz & 0x7f) | 0x80
-			sz >>= 7
-			i += 1
-		pkt[i] = sz
-		#print(hex(len(pkt)), hexlify(pkt, ":"))
-		self.sock.write(pkt, i + 1)
-		self._send_str(topic)
+		i = self._put_str(self._frame(0x30 | qos << 1 | retain | dup << 3, sz), topic)
 		if qos > 0:
-			self.pid += 1
-			pid = self.pid
-			struct.pack_into("!H", pkt, 0, pid)
-			self.sock.write(pkt, 2)
-		self.sock.write(msg)
-		if qos == 1:
-			while 1:
-				op = self.wait_msg()
-				if op == 0x40:
-					sz = self.sock.read(1)
-					assert sz == b"\x02"
-					rcv_pid = self.sock.read(2)
-					rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-					if pid == rcv_pid:
-						return
-		elif qos == 2:
-			assert 0
+			i = self._put_u16(i, pid)
+		self._send(self._put(i, msg))
+	def publish_msg(self, topic, codec, ts, ttl, payload, retain=False):	# QoS 0 message encoded by a msgs codec straight into the packet buffer
+		topic = _b(topic)
+		buf = self._buf
+		i = 7 + len(topic)	# room for the longest fixed header before the topic
+		if i > len(buf):
+			raise BufferFull("buffer full")
+		buf[5] = len(topic) >> 8
+		buf[6] = len(topic) & 0xff
+		buf[7:i] = topic
+		end = codec.encode(buf, i, ts, ttl, payload)	# BufferFull if it does not fit
+		sz = end - 5
+		start = 3 if sz < 0x80 else 2 if sz < 0x4000 else 1 if sz < 0x200000 else 0
+		self._frame(0x30 | retain, sz, start)	# length prefix patched in front of the topic
+		self.sock.write(buf, start, end - start)
+		self._last_tx = ticks_ms()
+	def publish_batch(self, msgs, retain=False):	# QoS 0 burst of (topic, msg), the frames are appended in the buffer and written together
+		i = 0
+		for topic, msg in msgs:
+			topic = _b(topic)
+			msg = _b(msg)
+			i = self._put_str(self._frame(0x30 | retain, 2 + len(topic) + len(msg), i), topic)
+			i = self._put(i, msg)
+		self._send(i)
 	def subscribe(self, topic, qos=0):
 		assert self.cb is not None, "Subscribe callback is not set"
-		pkt = bytearray(b"\x82\0\0\0")
-		self.pid += 1
-		struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-		#print(hex(len(pkt)), hexlify(pkt, ":"))
-		self.sock.write(pkt)
-		self._send_str(topic)
-		self.sock.write(qos.to_bytes(1, "little"))
+		topic = _b(topic)
+		pid = self._next_pid()
+		i = self._put_u16(self._frame(0x82, 2 + 2 + len(topic) + 1), pid)
+		i = self._put_str(i, topic)
+		self._send(self._put(i, bytes((qos,))))
 		while 1:
 			op = self.wait_msg()
 			if op == 0x90:
-				resp = self.sock.read(4)
-				#print(resp)
-				assert resp[1] == pkt[2] and resp[2] == pkt[3]
-				if resp[3] == 0x80:
-					raise MQTTException(resp[3])
+				resp = self._rbuf	# SUBACK body left by wait_msg()
+				assert resp[0] == pid >> 8 and resp[1] == pid & 0xff
+				if resp[2] == 0x80:
+					raise MQTTException(resp[2])
 				return
 	# Wait for a single incoming MQTT message and process it.
 	# Subscribed messages are delivered to a callback previously
 	# set by .set_callback() method. Other (internal) MQTT
-	# messages processed internally.
+	# messages processed internally, the body of the ones not
+	# processed is left at the start of the receive buffer.
+	# The topic and message given to the callback are memoryviews
+	# of the receive buffer, valid only until the callback returns,
+	# unless copy_msg is set. Messages larger than the buffer are
+	# read into new bytes objects.
 	def wait_msg(self):
-		res = self.sock.read(1)
+		res = self.sock.readinto(self._rmv[0:1])
 		self.sock.setblocking(True)
 		if res is None:
 			return None
-		if res == b"":
+		if res == 0:
 			raise OSError(-1)
-		if res == b"\xd0":  # PINGRESP
-			sz = self.sock.read(1)[0]
+		self._last_rx = ticks_ms()
+		buf = self._rbuf
+		op = buf[0]
+		sz = self._recv_len()
+		if op == 0xd0:  # PINGRESP
 			assert sz == 0
+			if self._ping_t is not None:
+				self._rtt(self._ping_t)
+				self._ping_t = None
 			return None
-		op = res[0]
+		if op == 0x40 or op == 0x50 or op == 0x62 or op == 0x70:  # PUBACK, PUBREC, PUBREL, PUBCOMP
+			assert sz == 2
+			self._recv(0, 2)
+			self._ack(op, buf[0] << 8 | buf[1])
+			return op
 		if op & 0xf0 != 0x30:
+			if sz:
+				self._recv(0, sz)
 			return op
-		sz = self._recv_len()
-		topic_len = self.sock.read(2)
-		topic_len = (topic_len[0] << 8) | topic_len[1]
-		topic = self.sock.read(topic_len)
-		sz -= topic_len + 2
-		if op & 6:
-			pid = self.sock.read(2)
-			pid = pid[0] << 8 | pid[1]
-			sz -= 2
-		msg = self.sock.read(sz)
+		if sz <= len(buf):
+			self._recv(0, sz)
+			p = 2 + (buf[0] << 8 | buf[1])
+			topic = self._rmv[2:p]
+			if op & 6:
+				pid = buf[p] << 8 | buf[p + 1]
+				p += 2
+			msg = self._rmv[p:sz]
+			if self.copy_msg:
+				topic = bytes(topic)
+				msg = bytes(msg)
+		else:
+			self._recv(0, 2)
+			topic_len = buf[0] << 8 | buf[1]
+			topic = self.sock.read(topic_len)
+			sz -= topic_len + 2
+			if op & 6:
+				self._recv(0, 2)
+				pid = buf[0] << 8 | buf[1]
+				sz -= 2
+			msg = self.sock.read(sz)
+		if op & 6 == 4:		# QoS 2, delivered once and acknowledged with PUBREC
+			if self._rx_qos2(pid):
+				self.cb(topic, msg)
+			self._send_ack(0x50, pid)
+			return
 		self.cb(topic, msg)
 		if op & 6 == 2:
-			pkt = bytearray(b"\x40\x02\0\0")
-			struct.pack_into("!H", pkt, 2, pid)
-			self.sock.write(pkt)
-		elif op & 6 == 4:
-			assert 0
+			self._send_ack(0x40, pid)
 	# Checks whether a pending message from server is available.
 	# If not, returns immediately with None. Otherwise, does
 	# the same processing as wait_msg.
 	def check_msg(self):
+		self.check_keepalive()
+		self._retransmit()
 		self.sock.setblocking(False)
 		return self.wait_msg()
 
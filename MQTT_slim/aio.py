@@ -0,0 +1,265 @@
+##############################################
+## Asyncio MQTT client.						##
+##											##
+# Same protocol subset as MQTT_slim.MQTTClient	##
+# but running on asyncio streams, so it works	##
+# on MicroPython uasyncio and on CPython.		##
+## Written by Juanma							##
+##############################################
+import Logging as logging
+logger = logging.getLogger(__name__)
+logger.log(logging.DEBUG,"Module [{}] loading",__name__)
+
+try:
+	import asyncio
+except ImportError:
+	import uasyncio as asyncio
+try:
+	import ustruct as struct
+except ImportError:
+	import struct
+from array import array
+import errno
+from MQTT_slim import MQTTException, ticks_ms, ticks_diff
+
+def _b(s):		# topics and messages may be given as str, streams only take bytes
+	return s.encode() if type(s) is str else s
+
+def _str(s):	# MQTT UTF-8 string: 16 bit length + data
+	s = _b(s)
+	return struct.pack("!H", len(s)) + s
+
+class MQTTClient:
+	def __init__(self, client_id, server, port=0, user=None, password=None,
+				 keepalive=0, ssl=False, ssl_params={}, inflight=8, ack_timeout=5000):
+		if port == 0:
+			port = 8883 if ssl else 1883
+		self.client_id = client_id
+		self.server = server.decode() if type(server) is bytes else server
+		self.port = port
+		self.ssl = ssl
+		self.ssl_params = ssl_params
+		self.pid = 0
+		self.cb = None
+		self.user = user
+		self.pswd = password
+		self.keepalive = keepalive
+		self.ack_timeout = ack_timeout	# ms to wait for a PINGRESP
+		self.lw_topic = None
+		self.lw_msg = None
+		self.lw_qos = 0
+		self.lw_retain = False
+		self._reader = None
+		self._writer = None
+		self._lock = None		# serializes drain(), several tasks may publish
+		self._listening = False	# listen() is reading the stream, acks are waited on events
+		self._waiters = {}		# pid -> [Event, return code] of the pending SUBACK/PUBACK
+		self._rx_pids = array("H", [0] * inflight)	# inbound QoS 2 packet ids delivered and waiting for their PUBREL
+		self._rx_next = 0		# next _rx_pids slot to reuse when all are taken
+		self._last_tx = 0		# ticks_ms() of the last packet queued
+		self._last_rx = 0		# ticks_ms() of the last packet received
+		self._ping_t = None		# ticks_ms() of the PINGREQ waiting for its PINGRESP
+		self.rtt = None			# smoothed broker round trip in ms, from PINGRESP
+	def _next_pid(self):
+		self.pid = self.pid % 65535 + 1	# packet ids are 16 bit and never 0
+		return self.pid
+	def _write(self, op, body):	# queues a packet in the stream, drain() sends it
+		self._writer.write(self._packet(op, body))
+		self._last_tx = ticks_ms()
+	def _packet(self, op, body):
+		pkt = bytearray(5)
+		pkt[0] = op
+		sz = len(body)
+		i = 1
+		while sz > 0x7f:
+			pkt[i] = (sz & 0x7f) | 0x80
+			sz >>= 7
+			i += 1
+		pkt[i] = sz
+		return pkt[:i + 1] + body
+	async def _read(self, n):
+		try:
+			return await self._reader.readexactly(n)
+		except EOFError:	# the broker closed the connection
+			raise OSError(-1)
+	async def _recv_len(self):
+		n = 0
+		sh = 0
+		while 1:
+			b = (await self._read(1))[0]
+			n |= (b & 0x7f) << sh
+			if not b & 0x80:
+				return n
+			sh += 7
+	def set_callback(self, f):
+		self.cb = f
+	def set_last_will(self, topic, msg, retain=False, qos=0):
+		assert 0 <= qos <= 2
+		assert topic
+		self.lw_topic = topic
+		self.lw_msg = msg
+		self.lw_qos = qos
+		self.lw_retain = retain
+	async def connect(self, clean_session=True):
+		if self.ssl:
+			self._reader, self._writer = await asyncio.open_connection(self.server, self.port, ssl=self.ssl_params or True)
+		else:
+			self._reader, self._writer = await asyncio.open_connection(self.server, self.port)
+		self._lock = asyncio.Lock()
+		msg = bytearray(b"\x00\x04MQTT\x04\x02\0\0")
+		msg[7] = clean_session << 1
+		if self.user is not None:
+			msg[7] |= 0xC0
+		if self.keepalive:
+			assert self.keepalive < 65536
+			msg[8] |= self.keepalive >> 8
+			msg[9] |= self.keepalive & 0x00FF
+		msg += _str(self.client_id)
+		if self.lw_topic:
+			msg[7] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+			msg[7] |= self.lw_retain << 5
+			msg += _str(self.lw_topic) + _str(self.lw_msg)
+		if self.user is not None:
+			msg += _str(self.user) + _str(self.pswd)
+		self._write(0x10, msg)
+		await self.drain()
+		resp = await self._read(4)
+		assert resp[0] == 0x20 and resp[1] == 0x02
+		if resp[3] != 0:
+			raise MQTTException(resp[3])
+		self._last_rx = ticks_ms()
+		self._ping_t = None
+		return resp[2] & 1
+	async def disconnect(self):
+		self._writer.write(b"\xe0\0")
+		await self.drain()
+		self._writer.close()
+		await self._writer.wait_closed()
+	def close(self):	# drops the connection without DISCONNECT, so the broker publishes the last will
+		if self._writer:
+			self._writer.close()
+	async def drain(self):	# sends everything queued by publish() and ping()
+		async with self._lock:
+			await self._writer.drain()
+	def ping(self):
+		self._writer.write(b"\xc0\0")
+		self._last_tx = ticks_ms()
+		if self._ping_t is None:
+			self._ping_t = self._last_tx
+	def check_keepalive(self):	# same keepalive tracking as MQTT_slim.MQTTClient, drain() sends the PINGREQ
+		if not self.keepalive:
+			return
+		now = ticks_ms()
+		if self._ping_t is not None:
+			if ticks_diff(now, self._ping_t) >= self.ack_timeout:
+				self._ping_t = None
+				raise OSError(errno.ETIMEDOUT)
+		elif ticks_diff(now, self._last_tx) >= self.keepalive * 500 or ticks_diff(now, self._last_rx) >= self.keepalive * 500:
+			self.ping()
+	def ping_in(self):	# ms until check_keepalive() has something to do, None without keepalive
+		if not self.keepalive:
+			return None
+		now = ticks_ms()
+		if self._ping_t is not None:
+			return max(0, self.ack_timeout - ticks_diff(now, self._ping_t))
+		return max(0, self.keepalive * 500 - max(ticks_diff(now, self._last_tx), ticks_diff(now, self._last_rx)))
+	def publish(self, topic, msg, retain=False, qos=0):	# queues the message without waiting for the broker, returns the packet id for QoS 1
+		assert qos < 2, "QoS 2 publishing is only supported by MQTT_slim.MQTTClient"
+		pid = None
+		body = _str(topic)
+		if qos > 0:
+			pid = self._next_pid()
+			body += struct.pack("!H", pid)
+		self._write(0x30 | qos << 1 | retain, body + _b(msg))
+		return pid
+	def publish_batch(self, msgs, retain=False):	# QoS 0 burst of (topic, msg), queued with a single write
+		self._writer.write(b"".join([self._packet(0x30 | retain, _str(topic) + _b(msg)) for topic, msg in msgs]))
+		self._last_tx = ticks_ms()
+	async def subscribe(self, topic, qos=0):
+		assert self.cb is not None, "Subscribe callback is not set"
+		pid = self._next_pid()
+		self._write(0x82, struct.pack("!H", pid) + _str(topic) + bytes((qos,)))
+		await self.drain()
+		if await self._wait_ack(pid) == 0x80:
+			raise MQTTException(0x80)
+	async def _wait_ack(self, pid):	# returns the SUBACK return code (0 for PUBACK) of pid
+		w = self._waiters[pid] = [asyncio.Event(), None]
+		try:
+			if self._listening:		# listen() reads the ack and sets the event
+				await w[0].wait()
+			else:
+				while not w[0].is_set():
+					await self.wait_msg()
+		finally:
+			del self._waiters[pid]
+		return w[1]
+	# Wait for a single incoming MQTT packet and process it.
+	# Subscribed messages are delivered to the callback set by
+	# .set_callback(), other packets are consumed internally and
+	# their type is returned.
+	async def wait_msg(self):
+		op = (await self._read(1))[0]
+		self._last_rx = ticks_ms()
+		sz = await self._recv_len()
+		if op & 0xf0 == 0x30:	# PUBLISH
+			topic_len = await self._read(2)
+			topic_len = (topic_len[0] << 8) | topic_len[1]
+			topic = await self._read(topic_len)
+			sz -= topic_len + 2
+			if op & 6:
+				pid = await self._read(2)
+				pid = pid[0] << 8 | pid[1]
+				sz -= 2
+			msg = await self._read(sz) if sz else b""
+			if op & 6 == 4:		# QoS 2, delivered once and acknowledged with PUBREC
+				if self._rx_qos2(pid):
+					self.cb(topic, msg)
+				self._write(0x50, struct.pack("!H", pid))
+				await self.drain()
+				return None
+			self.cb(topic, msg)
+			if op & 6 == 2:
+				self._write(0x40, struct.pack("!H", pid))
+				await self.drain()
+			return None
+		body = await self._read(sz) if sz else b""
+		if op == 0xd0:	# PINGRESP
+			if self._ping_t is not None:
+				t = ticks_diff(ticks_ms(), self._ping_t)
+				self.rtt = t if self.rtt is None else self.rtt + (t - self.rtt) // 8
+				self._ping_t = None
+			return None
+		if op == 0x62:	# PUBREL of an inbound QoS 2 message
+			pid = body[0] << 8 | body[1]
+			for i in range(len(self._rx_pids)):
+				if self._rx_pids[i] == pid:
+					self._rx_pids[i] = 0
+			self._write(0x70, body[:2])	# PUBCOMP
+			await self.drain()
+			return op
+		if op == 0x40 or op == 0x90:	# PUBACK, SUBACK
+			w = self._waiters.get(body[0] << 8 | body[1])
+			if w:
+				w[1] = body[-1] if op == 0x90 else 0
+				w[0].set()
+		return op
+	def _rx_qos2(self, pid):	# True if the inbound QoS 2 message pid is new and must be delivered
+		if pid in self._rx_pids:	# redelivery before our PUBREC reached the broker
+			return False
+		rx = self._rx_pids
+		for i in range(len(rx)):
+			if not rx[i]:
+				rx[i] = pid
+				return True
+		rx[self._rx_next] = pid		# table full, forgets the oldest slot
+		self._rx_next = (self._rx_next + 1) % len(rx)
+		return True
+	async def listen(self):	# reads the stream forever, to be run as a task
+		self._listening = True
+		try:
+			while 1:
+				await self.wait_msg()
+		finally:
+			self._listening = False
+
+logger.log(logging.DEBUG,"Module [{}] loaded",__name__)
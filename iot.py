@@ -4,14 +4,23 @@
 ## Written by Juanma					##
 ##########################################
 import Logging as logging
-logger = logging.getLogger(__name__)   # Gets the logger that should be stablished in setup or main, but if not, it creates  new one in DEBUG mode
-logger.level=logging.DEBUG
+logger = logging.getLogger(__name__)   # Gets the logger that should be stablished in setup or main, its level follows Logging.basicConfig() unless set with setLevel()
 logger.log(logging.DEBUG,"Module [{}] loading",__name__)
 
 import ts, msgs
 from MQTT_slim import MQTTClient     
 
-import io,json, time, network, machine, binascii, os, sys
+import io,json, time, network, machine, binascii, os, sys, heapq, random, array, math
+asyncio=None	# imported by _load_asyncio() on the first async call, the synchronous API does not need it
+
+def _load_asyncio():
+    global asyncio
+    if asyncio is None:
+        try:
+            import asyncio as a
+        except ImportError:
+            import uasyncio as a
+        asyncio=a
 
 NETWORK_STATE={
     network.STAT_IDLE: "STAT_IDLE",
@@ -29,6 +38,18 @@ SENSOR_DATA_PULL	=const(1)
 SENSOR_DATA_PUSH	=const(2)
 SENSOR_CONTROL 		=const(4)
 
+#Device publish batching modes, see Device.set_batching()
+BATCH_OFF			=const(0)	# every push is published on its own
+BATCH_MERGE			=const(1)	# one multi-value message per sensor topic
+BATCH_BURST			=const(2)	# one message per value, all sent in a single socket write
+_MERGE_BYTES		=const(16)	# estimated bytes of a BATCH_MERGE reading besides its name, "name": value
+_OBUF_MAX			=const(16384)	# bytes, largest encoded sensor message
+_RX_TOPICS			=const(64)	# inbound topics whose last "ts" is kept, the oldest one is forgotten first
+
+#Publishing priorities, PRIO_CONTROL readings may use the tokens TokenBucket reserves
+PRIO_CONTROL		=const(0)	# results of the values written from the broker, default of SENSOR_CONTROL values
+PRIO_TELEMETRY		=const(1)	# the other readings
+
 #IoT Events reported by callback
 EVT_MQTT_Unknown	=const(0)
 EVT_MQTT_rcv_msg	=const(1)
@@ -42,7 +63,13 @@ __license__ = "Apache-2.0"
 IOT_MODE=const(0)	# for path input or output 	Example: "sensors/buttons/values"
 DIC_MODE=const(1)	# for path output ready for eval() function. Example: "['sensors']['buttons']['values']"
 
-def find_key(dic, key, mode=IOT_MODE, level=0,  ):
+def _dic_path(path):	# converts an IOT_MODE path into a DIC_MODE one
+    return "['{}']".format(path.replace("/","']['"))
+
+def find_key(dic, key, mode=IOT_MODE, level=0, index=None):	# index is the TreeIndex of dic, answers without walking the tree
+    if index and index.tree is dic:
+        p=index.key(key)
+        return p if mode is IOT_MODE or not p else _dic_path(p)
     level+=1
     for k in dic.keys():
         #print("level({}), check({})".format(level, k))
@@ -64,7 +91,10 @@ def find_key(dic, key, mode=IOT_MODE, level=0,  ):
                         return "['{}']{}".format(k,result )
     return ""
 
-def find_val(dic, val, mode=IOT_MODE):
+def find_val(dic, val, mode=IOT_MODE, index=None):
+    if index and index.tree is dic:
+        p=index.val(val)
+        return p if mode is IOT_MODE or not p else _dic_path(p)
     for k, v in dic.items():
         #print("check({})".format((k, v)))
         if v is val:
@@ -83,7 +113,10 @@ def find_val(dic, val, mode=IOT_MODE):
                         return "['{}']{}".format(k,result )
     return ""
 
-def find_path(dic, path, mode=IOT_MODE):
+def find_path(dic, path, mode=IOT_MODE, index=None):
+    if index and index.tree is dic:
+        retval=index.paths(path)
+        return retval if mode is IOT_MODE else [_dic_path(p) for p in retval]
     retval=[]
     org = dic
     def list_paths(dic):
@@ -102,6 +135,293 @@ def find_path(dic, path, mode=IOT_MODE):
         return retval
     return list_paths(dic)
 
+class TreeIndex:	# Identity keyed index of a device tree. find_key(), find_val() and find_path() use it when passed as index
+    def __init__(self, tree, root_topic=None):
+        self.tree=tree
+        self.root_topic=root_topic	# prefix for the precomputed publish topics
+        self.rebuild()
+    def rebuild(self):	# (re)walks the whole tree, needed only when the tree structure changes
+        self._vals={}	# id(value) -> path of its first occurrence, same answer as the recursive find_val()
+        self._keys={}	# key -> path of its first occurrence, same answer as the recursive find_key()
+        self._nodes=[]	# every value in walk order, for find_path()
+        self._topics={}	# id(value) -> publish topic, bytes so publishing does not encode it on every reading
+        self._walk(self.tree, None)
+        self._topic_set=set(self._topics.values())
+    def _walk(self, dic, prefix):
+        for k, v in dic.items():
+            p = k if prefix is None else "/".join((prefix, k))
+            if k not in self._keys:
+                self._keys[k]=p
+            if id(v) not in self._vals:
+                self._vals[id(v)]=p
+                if self.root_topic:
+                    self._topics[id(v)]="/".join((self.root_topic, p)).encode()
+            self._nodes.append(v)
+            if type(v) is dict:
+                self._walk(v, p)
+    def set_root_topic(self, root_topic):
+        self.root_topic=root_topic
+        self.rebuild()
+    def key(self, key):
+        return self._keys.get(key, "")
+    def val(self, val):
+        return self._vals.get(id(val), "")
+    def topic(self, val):	# precomputed b"root_topic/path" of val, None if not indexed or root_topic is not known yet
+        return self._topics.get(id(val))
+    def is_topic(self, topic)->bool:	# True if topic is one of the precomputed topics
+        return topic in self._topic_set
+    def paths(self, path):
+        retval=[]
+        for v in self._nodes:
+            p=self._vals[id(v)]
+            if p.endswith(path):
+                retval.append(p)
+        return retval
+
+class TopicTrie:	# MQTT topic filters, with "+" and "#" wildcards, mapped to handlers
+    # Filters without wildcards are matched with a single dict lookup of the whole topic. The others
+    # are compiled into a trie of [handler, [(level, node)], "+" node, "#" handler] nodes that is walked
+    # comparing each level in place with find()/startswith(), so the topic is never split or sliced.
+    def __init__(self):
+        self.clear()
+    def clear(self):
+        self._exact={}
+        self._root=[None, [], None, None]
+    def add(self, filter, handler):	# handler(topic, payload), None removes the filter
+        f=filter.encode() if type(filter) is str else filter
+        if b"+" not in f and b"#" not in f:
+            if handler is None: self._exact.pop(f, None)
+            else: self._exact[f]=handler
+            return
+        node=self._root
+        for level in f.split(b"/"):
+            if level==b"#":
+                node[3]=handler
+                return
+            if level==b"+":
+                if node[2] is None: node[2]=[None, [], None, None]
+                node=node[2]
+                continue
+            for l, n in node[1]:
+                if l==level:
+                    node=n
+                    break
+            else:
+                n=[None, [], None, None]
+                node[1].append((level, n))
+                node=n
+        node[0]=handler
+    def match(self, topic):	# handler of the filter matching topic (bytes), literal levels win over "+" and "+" over "#". None if none
+        h=self._exact.get(topic)
+        if h is None:
+            h=self._match(self._root, topic, 0)
+        return h
+    def _match(self, node, t, i):	# matches the levels of t from position i
+        if i>len(t):	# all levels matched, "a/#" also matches "a"
+            return node[0] if node[0] is not None else node[3]
+        j=t.find(b"/", i)
+        if j<0: j=len(t)
+        for level, n in node[1]:
+            if len(level)==j-i and t.startswith(level, i):
+                h=self._match(n, t, j+1)
+                if h is not None: return h
+        if node[2] is not None:
+            h=self._match(node[2], t, j+1)
+            if h is not None: return h
+        return node[3]
+
+_BUCKET_UNITS=const(0x10000000)	# TokenBucket capacity in units, the refill sums stay small ints on 32 bit ports
+
+class TokenBucket:	# Publishing rate limit of rate tokens per second with bursts of up to burst tokens
+    def __init__(self, rate, burst=1, reserve=0):	# reserve tokens are kept for PRIO_CONTROL
+        if not rate>0:
+            raise ValueError("rate must be >0")
+        if not 0<=reserve<burst:
+            raise ValueError("reserve must be >=0 and <burst")
+        one=_BUCKET_UNITS//(burst+1)	# units per token
+        per_ms=rate*one/1000
+        step=1 if per_ms>=1000 else int(1000/per_ms)+1	# ms per refill, low rates add at least 1000 units per step
+        if step>_BUCKET_UNITS:
+            raise ValueError("rate too low")
+        self._one=one
+        self._size=burst*one
+        self._reserve=reserve*one
+        self._step=step
+        self._rate=min(self._size, int(per_ms*step)+1)	# units per step rounded up, so a token is never a ms late. Rates over 1000*burst per second are capped
+        self._fill=self._size//self._rate+1	# steps to fill it from empty, caps the refill product
+        self._units=self._size
+        self._t=ts.ticks_ms()	# start of the current step
+        self.passed=0		# readings published
+        self.throttled=0	# times a reading had to wait for a token
+    def _refill(self)->int:	# returns the ms elapsed in the current step
+        d=ts.ticks_diff(ts.ticks_ms(), self._t)
+        if d<self._step:
+            return max(d, 0)
+        k=d//self._step
+        self._t=ts.ticks_add(self._t, k*self._step)
+        if self._units<self._size:
+            self._units=min(self._size, self._units+min(k, self._fill)*self._rate)
+        return d-k*self._step
+    def wait(self, prio=PRIO_TELEMETRY)->int:	# ms until a token is available for prio, 0 if now
+        d=self._refill()
+        need=self._one+(self._reserve if prio>PRIO_CONTROL else 0)
+        if self._units>=need:
+            return 0
+        return (need-self._units+self._rate-1)//self._rate*self._step-d
+    def take(self):
+        self._units-=self._one
+        self.passed+=1
+
+_REBASE=const(0x10000000)	# ms, Scheduler rebases the deadlines well before ticks_diff() could overflow
+
+class Scheduler:	# Deadline heap of Values, so Device.process() only touches the values that are due
+    def __init__(self):
+        self._heap=[]	# (due, priority, seq, value) entries, due in ms since self._t0. Stale entries are skipped when popped
+        self._seq=0		# tie breaker so values are never compared
+        self.on_wake=None	# called when a push() schedules a value, Device.run() uses it to stop sleeping
+        self.bucket=None	# TokenBucket of the Device, shared by all the values
+        self._t0=ts.ticks_ms()
+    def now(self)->int:	# ms since self._t0
+        now=ts.ticks_diff(ts.ticks_ms(), self._t0)
+        if now>_REBASE:	# shifts all deadlines by the same amount, which keeps the heap order
+            self._t0=ts.ticks_add(self._t0, now)
+            heap=[]
+            for due, prio, seq, value in self._heap:
+                if value._due==due and value._sched is self:	# keeps only the live entries
+                    value._due=due-now
+                    if value._last is not None: value._last-=now
+                    if value._sent_t is not None: value._sent_t-=now
+                    heap.append((due-now, prio, seq, value))
+            heapq.heapify(heap)
+            self._heap=heap
+            now=0
+        return now
+    def _push(self, value, due):
+        value._due=due
+        self._seq+=1
+        heapq.heappush(self._heap, (due, value._prio, self._seq, value))	# control values first when due together
+    def add(self, value):		# registers the value, it is processed on the next run()
+        value._sched=self
+        self._push(value, self.now())
+    def remove(self, value):
+        value._sched=None
+        value._due=None		# its heap entry becomes stale
+    def wake(self, value):		# called by Value.push(), schedules the value as soon as freq_max allows
+        if value._sched is not self: return
+        due=self.now()
+        if value.bucket:
+            due+=value.bucket.wait(value._prio)
+        if value._due is None or due<value._due:
+            self._push(value, due)
+            if self.on_wake: self.on_wake()
+    def defer(self, value, due):	# schedules the value at due unless it is due earlier
+        if value._due is None or due<value._due:
+            self._push(value, due)
+    def run(self)->int:	# processes the due values, returns how many were processed
+        i=0
+        now=self.now()
+        heap=self._heap
+        while heap and heap[0][0]<=now:
+            due, prio, seq, value=heapq.heappop(heap)
+            if value._due!=due or value._sched is not self:	# stale entry, the value was rescheduled or removed
+                continue
+            value._due=None
+            i+=value.process(now)
+            if value._period:
+                due=value._last+value._period
+                if value._due is None or due<value._due:	# a push() from the callbacks may have scheduled it earlier
+                    self._push(value, due)
+        return i
+    def sleep_time(self, max_sleep=None)->int:	# ms until the next deadline, capped to max_sleep
+        heap=self._heap
+        while heap and heap[0][3]._due!=heap[0][0]:
+            heapq.heappop(heap)		# drops stale entries
+        if not heap:
+            return max_sleep
+        t=max(0, heap[0][0]-self.now())
+        return t if max_sleep is None else min(t, max_sleep)
+
+class Window:	# Ring of the samples of a Value, with the aggregates of the current window computed as they arrive
+    STATS=("min", "max", "mean", "stddev", "last", "count")
+    def __init__(self, size, typecode="f", stats=None):	# size samples per window, stored as array typecode
+        self._buf=array.array(typecode, [0]*size)
+        self._i=0			# next position in the ring
+        self.stats=stats or self.STATS	# aggregates published for each window
+        self.result=None	# {stat: value} of the last window closed
+        self.ready=False	# a window was closed and not published yet
+        self._reset()
+    def _reset(self):
+        self.n=0
+        self._min=None
+        self._max=None
+        self._mean=0.0
+        self._m2=0.0		# sum of squared differences from the mean (Welford)
+        self._last=None
+    def add(self, x)->bool:	# adds a sample, True when it closes the window
+        self._buf[self._i]=x
+        self._i=(self._i+1)%len(self._buf)
+        self.n+=1
+        if self._min is None or x<self._min: self._min=x
+        if self._max is None or x>self._max: self._max=x
+        d=x-self._mean
+        self._mean+=d/self.n
+        self._m2+=d*(x-self._mean)
+        self._last=x
+        if self.n>=len(self._buf):
+            self.close()
+            return True
+        return False
+    def close(self)->None:	# ends the current window, its aggregates become the result
+        if not self.n:
+            return
+        agg={"min": self._min, "max": self._max, "mean": self._mean, "stddev": math.sqrt(self._m2/self.n),
+             "last": self._last, "count": self.n}
+        self.result={k:agg[k] for k in self.stats}
+        self.ready=True
+        self._reset()
+    def samples(self)->array.array:	# the last len(ring) samples, oldest first
+        b=self._buf
+        return b[self._i:]+b[:self._i]
+
+class IrqQueue:	# Preallocated single producer queue of Value pushes, posted from interrupt handlers
+    # post() only stores small ints in the arrays and moves _head, so it neither allocates nor
+    # needs a lock: the handler is the only writer of _head and Device.process() of _tail.
+    def __init__(self, size=16):
+        self._ids=array.array("H", [0]*size)	# Value slot posted
+        self._t=array.array("L", [0]*size)		# ts.ticks_us() when posted
+        self._head=0		# next entry written by post()
+        self._tail=0		# next entry read by drain()
+        self.values=[]		# Values by slot
+        self.overflows=0	# posts lost because the queue was full
+        self.flag=None		# asyncio.ThreadSafeFlag set by post(), wakes Device.run()
+    def add(self, value)->int:	# gives value a slot, returns it
+        self.values.append(value)
+        return len(self.values)-1
+    def post(self, slot)->bool:	# called from the interrupt handler, False if the queue is full
+        i=self._head
+        n=(i+1)%len(self._ids)
+        if n==self._tail:
+            self.overflows+=1
+            return False
+        self._ids[i]=slot
+        self._t[i]=ts.ticks_us()
+        self._head=n
+        if self.flag is not None:
+            self.flag.set()
+        return True
+    def drain(self)->int:	# pushes the posted Values, in the main context, returns how many
+        i=self._tail
+        k=0
+        while i!=self._head:
+            v=self.values[self._ids[i]]
+            if v._irq_t is None:	# the oldest post of a value sets the latency reference
+                v._irq_t=self._t[i]
+            v.push()
+            i=(i+1)%len(self._ids)
+            k+=1
+        self._tail=i
+        return k
+
 class Config:
     version=__version__
     def __init__(self, config=None): # receive all the attributes as a dictionary
@@ -200,6 +520,9 @@ class Device:
     def id(self):
         return self._config.iot_id
         return c
+    @property
+    def rtt(self):	# smoothed broker round trip in ms, None until measured
+        return self._mqtt.rtt if self._mqtt else None
     def save_config(self, file_name=None):
         self._config.version=__version__	#Update version to configuration
         if file_name:
@@ -228,9 +551,48 @@ class Device:
                     "name":self.name,
                     "id":self.id,
                     "type":self.type,
+                    "codec":msgs.JSON.name,	# encoding of the sensor messages, see set_codec()
                     "root_topic":None},
                 "sensors":{},
                     }
+        self._index=TreeIndex(self._device_tree)	# _sensor_callback() and find_*(..., index=device._index) are answered from here
+        self._scheduler=Scheduler()	# deadlines of all the sensor values
+        self._irq=None			# IrqQueue of the Value.irq() handlers, see set_irq()
+        self._log=None			# Logging.MQTTHandler shipping the logs, see set_remote_log()
+        self._irq_poll=None		# ms process() sleeps at most while it is enabled
+        self.irq_events=0		# pushes posted by interrupt handlers and published
+        self.irq_latency=None	# µs from the last of them to its publication
+        self.irq_latency_max=0	# µs, worst case
+        self._batch_mode=BATCH_OFF
+        self._batch={}			# id(value) -> (topic, value name, timestamp, reading, BATCH_BURST message, size) of the pending pushes
+        self._batch_bytes=0		# size of the pending messages, estimated for BATCH_MERGE
+        self._batch_t0=0		# ticks_ms() of the first pending push
+        self._online=False		# the broker connection is up, cleared when a publish fails
+        self._outbox=None		# outbox.Outbox keeping the messages published while offline
+        self._outbox_ttl=0		# seconds the queued sensor readings are kept, 0 forever
+        self._drain_rate=0		# queued messages republished per second once online
+        self._drain_credit=0	# messages*1000 allowed to be republished now
+        self._drain_t=0			# ticks_ms() of the last drain
+        self._sub_topic=None	# subscription renewed when the broker lost the session
+        self._avail_topic=None	# retained availability, cleared by the last will
+        self._backoff_min=1000	# ms, first reconnect delay, doubled on each failure
+        self._backoff_max=60000	# ms, reconnect delay limit
+        self._backoff=self._backoff_min
+        self._lost_t=0			# ticks_ms() when the connection was lost
+        self._retry_t=0			# ticks_ms() of the next reconnect attempt
+        self._rx_task=None		# asyncio task reading the broker stream in run()
+        self.reconnects=0		# successful reconnections
+        self.reconnect_ms=0		# duration of the last outage, from its detection to the CONNACK
+        self.lost=0				# messages dropped while offline without an outbox
+        self._routes=TopicTrie()	# inbound topic -> Sensor, Value or application handler
+        self._app_routes=[]		# (filter, handler, raw) added by route()
+        self._codec=msgs.JSON	# msgs codec of the sensor messages and the inbound non JSON ones
+        self._obuf=bytearray(256)	# messages are encoded here
+        self._rx_ts={}			# topic -> "ts" of the last message delivered, older or equal ones are dropped
+        self._rx_order=[None]*_RX_TOPICS	# ring of the _rx_ts topics in insertion order
+        self._rx_next=0			# _rx_order slot of the next new topic
+        self.rx_expired=0		# inbound messages dropped because their ttl was over
+        self.rx_duplicates=0	# inbound messages dropped because they were not newer than the last one of their topic
     def set_callback(self, callback):	# sets a callback function to report all IoT events
         self._callback=callback
     def start_device(self):				# Starts Network, register device, Notify availability
@@ -246,6 +608,32 @@ class Device:
         self.available()	# Notify to subscribers that the device is available
         return True
     def start_net(self): # Network startup
+        c=self._config
+        s=self._net_connect()
+        if c.netw_type!=network.AP_IF:
+            while s==network.STAT_CONNECTING:
+                logger.log(logging.DEBUG,__class__.__name__+".start_net('{}'): {}",c.ntp_svr, NETWORK_STATE[s])
+                time.sleep(1)
+                s=network.WLAN(c.netw_type).status()
+            self._net_status(s)
+            if not self.start_ntp():
+                logger.log(logging.DEBUG,__class__.__name__+".start_net('{}'):NTP Not synced",c.ntp_svr)
+            else:
+                logger.log(logging.DEBUG,__class__.__name__+".start_net('{}'):NTP synced",c.ntp_svr)	
+        logger.log(logging.DEBUG,__class__.__name__+".start_net():Network config:{}", network.WLAN(c.netw_type).ifconfig())
+    async def start_net_async(self): # Network startup, yielding to other tasks while the station connects
+        _load_asyncio()
+        c=self._config
+        s=self._net_connect()
+        if c.netw_type!=network.AP_IF:
+            while s==network.STAT_CONNECTING:
+                await asyncio.sleep(0.1)
+                s=network.WLAN(c.netw_type).status()
+            self._net_status(s)
+            if not await self.start_ntp_async():
+                logger.log(logging.DEBUG,__class__.__name__+".start_net_async('{}'):NTP Not synced",c.ntp_svr)
+        logger.log(logging.DEBUG,__class__.__name__+".start_net_async():Network config:{}", network.WLAN(c.netw_type).ifconfig())
+    def _net_connect(self)->int: # Configures the interface and starts the connection, returns the status
         c=self._config
         if c.netw_type==network.AP_IF:
             network.WLAN(c.netw_type).active(True)
@@ -258,21 +646,13 @@ class Device:
             network.WLAN(c.netw_type).active(True)
             network.WLAN(c.netw_type).ifconfig((c.netw_ip, c.netw_subnet, c.netw_gateway, c.netw_dns))
             network.WLAN(c.netw_type).connect(c.netw_essid, c.netw_password)
-            s=network.STAT_CONNECTING
-            while s==network.STAT_CONNECTING:
-                logger.log(logging.DEBUG,__class__.__name__+".start_net('{}'): {}",c.ntp_svr, NETWORK_STATE[s])
-                time.sleep(1)
-                s=network.WLAN(c.netw_type).status()
-            if s in NETWORK_STATE:
-                logger.log(logging.DEBUG,__class__.__name__+".start_net('{}'): {}",c.ntp_svr, NETWORK_STATE[s])
-            else:
-                logger.log(logging.ERROR,__class__.__name__+".start_net('{}'): Network status [{}] unknown.",c.ntp_svr, s)
-                
-            if not self.start_ntp():
-                logger.log(logging.DEBUG,__class__.__name__+".start_net('{}'):NTP Not synced",c.ntp_svr)
-            else:
-                logger.log(logging.DEBUG,__class__.__name__+".start_net('{}'):NTP synced",c.ntp_svr)	
-        logger.log(logging.DEBUG,__class__.__name__+".start_net():Network config:{}", network.WLAN(c.netw_type).ifconfig())
+        return network.STAT_CONNECTING
+    def _net_status(self, s):	# logs the final station status
+        c=self._config
+        if s in NETWORK_STATE:
+            logger.log(logging.DEBUG,__class__.__name__+".start_net('{}'): {}",c.ntp_svr, NETWORK_STATE[s])
+        else:
+            logger.log(logging.ERROR,__class__.__name__+".start_net('{}'): Network status [{}] unknown.",c.ntp_svr, s)
     def start_ntp(self): # NTP startup   
         c=self._config
         self._timestamp = ts.timestamp( ntp_server=c.ntp_svr )
@@ -285,58 +665,262 @@ class Device:
             if tmo == 0:
                 break
         return self._timestamp.ntp_synced()
+    async def start_ntp_async(self): # NTP startup, yielding to other tasks between retries
+        _load_asyncio()
+        c=self._config
+        self._timestamp = ts.timestamp( ntp_server=c.ntp_svr )
+        for tmo in range(10):
+            if await self._timestamp.ntp_synced_async():
+                return True
+            await asyncio.sleep(1)
+        return False
 
-    def _mqtt_callback(self, topic, msg):
-        logger.log(logging.DEBUG,__class__.__name__+"._mqtt_callback(topic={}, msg={})",topic, msg)
-        if self._callback:
-            try:
-                data=json.loads(msg)
-                #TODO: Process "tst", "ttl" and avoid expired data  
-                #logger.log(logging.DEBUG,__class__.__name__+"._mqtt_callback(data={})",data)
-                for item,value in data.items():
-                    if item=="pld":  # data is valid payload
-                        if type(topic)==bytes:  
-                            topic=topic.decode()
-                        self._callback(event=EVT_MQTT_rcv_msg, args=(topic, value) )
-            except Exception as e:
-                #sys.print_exception(e)
-                logger.log(logging.DEBUG,__class__.__name__+".start_mqtt(client_id={}, broker={}, port={}, user={}):MQTT Connecting, Exception:[{}]", client_id, c.mqtt_broker, c.mqtt_port, user, e)
-                
+    def _mqtt_callback(self, topic, msg):	# topic and msg may be memoryviews of the MQTT receive buffer, valid only during the call
+        if __debug__ and logger.isEnabledFor(logging.DEBUG): logger.log(logging.DEBUG,__class__.__name__+"._mqtt_callback(topic={}, msg={})",topic, msg)
+        topic=bytes(topic)
+        handler=self._routes.match(topic)	# Sensor/Value/route() handler, otherwise the application callback
+        if handler is None and not self._callback:
+            return		# nobody listens, the message is not even decoded
+        try:
+            env=msgs.Envelope(bytes(msg), self._codec)	# reads "ts" and "ttl", the payload is decoded only if delivered
+            if not env.has_payload() or not self._rx_fresh(topic, env):
+                return
+            if handler:
+                handler, raw=handler
+                handler(topic, env if raw else env.payload())
+            else:
+                self._callback(event=EVT_MQTT_rcv_msg, args=(str(topic, "UTF-8"), env.payload()) )
+        except Exception as e:
+            #sys.print_exception(e)
+            logger.log(logging.DEBUG,__class__.__name__+"._mqtt_callback(topic={}):Exception:[{}]", topic, e)
+    def _rx_fresh(self, topic, env)->bool:	# False if the message is expired or not newer than the last one of its topic
+        if env.ts is None:
+            return True
+        if env.ttl:
+            t=env.ts//1000000-ts.UNIX_OFFSET if type(env.ts) is int else ts.str2secs(env.ts)	# µs are Unix epoch, time.time() may not be
+            if t is not None and time.time()-t>env.ttl:
+                self.rx_expired+=1
+                if __debug__ and logger.isEnabledFor(logging.DEBUG): logger.log(logging.DEBUG,__class__.__name__+"._rx_fresh(topic={}): expired, ts={} ttl={}",topic, env.ts, env.ttl)
+                return False
+        if self._index.is_topic(topic):	# echoes of the device's own readings are not tracked
+            return True
+        last=self._rx_ts.get(topic)
+        if type(last) is type(env.ts) and env.ts<=last:	# µs and timestamp_str() strings sort in time order
+            self.rx_duplicates+=1
+            if __debug__ and logger.isEnabledFor(logging.DEBUG): logger.log(logging.DEBUG,__class__.__name__+"._rx_fresh(topic={}): duplicate, ts={} last={}",topic, env.ts, last)
+            return False
+        if last is None:	# new topic, replaces the oldest one once the ring is full
+            old=self._rx_order[self._rx_next]
+            if old is not None:
+                del self._rx_ts[old]
+            self._rx_order[self._rx_next]=topic
+            self._rx_next=(self._rx_next+1)%_RX_TOPICS
+        self._rx_ts[topic]=env.ts
+        return True
+    def route(self, filter, handler, raw=False):	# handler(topic, payload) for the inbound messages matching filter ("+" and "#" allowed), None removes it
+        # with raw=True the handler gets the msgs.Envelope instead, and decodes the payload only if it needs it
+        self._app_routes=[r for r in self._app_routes if r[0]!=filter]
+        if handler:
+            self._app_routes.append((filter, handler, raw))
+        self._build_routes()
+    def _build_routes(self):	# compiles the Sensor, Value and route() handlers, needed when the tree or the root topic change
+        r=self._routes
+        r.clear()
+        if self._device_tree["registration"]["root_topic"]:
+            for name, s in self._device_tree["sensors"].items():
+                sensor=s["object"]
+                if hasattr(sensor, "_message"):	# the driver takes commands on "<root_topic>/sensors/<name>/set"
+                    r.add(self._index.topic(s)+b"/set", (sensor.message, False))
+                for v in s["values"].values():	# SENSOR_CONTROL values on "<root_topic>/sensors/<name>/values/<value>/set"
+                    if v._set and v._type & SENSOR_CONTROL:
+                        r.add(self._index.topic(v)+b"/set", (v.message, False))
+        for f, h, raw in self._app_routes:
+            r.add(f, (h, raw))
 
-    def start_mqtt(self):
+    def _new_mqtt(self, client_class, keepalive=0):	# creates the MQTT_slim.MQTTClient or MQTT_slim.aio.MQTTClient from the config
         c=self._config
         client_id=self.id.decode("UTF-8") if self.id else None
         user=c.mqtt_username.decode("UTF-8") if c.mqtt_username else None
         password=c.mqtt_password.decode("UTF-8") if c.mqtt_password else None
         logger.log(logging.DEBUG,__class__.__name__+".start_mqtt(client_id={}, broker={}, port={}, user={}):MQTT Connecting", client_id, c.mqtt_broker, c.mqtt_port, user)
-        self._mqtt = MQTTClient(client_id = client_id, 
+        self._mqtt = client_class(client_id = client_id, 
                             server = c.mqtt_broker, 
                             port=c.mqtt_port, 
                             user = user, 
-                            password=password)
+                            password=password,
+                            keepalive=keepalive)
         self._mqtt.set_callback(self._mqtt_callback)
-        try:
-            self._mqtt.connect()
-        except Exception as e:
-            sys.print_exception(e)
-            logger.log(logging.DEBUG,__class__.__name__+".start_mqtt(client_id={}, broker={}, port={}, user={}):MQTT Connecting, Exception:[{}]", client_id, c.mqtt_broker, c.mqtt_port, user, e)
+    def _set_root_topic(self)->str:	# sets the registration root topic, returns the subscription topic
+        self._device_tree["registration"]["root_topic"]="/".join((self._config.mqtt_path,self.name.decode('UTF-8')))
+        self._index.set_root_topic(self._device_tree["registration"]["root_topic"])	# precomputes all publish topics
+        self._build_routes()
+        return "/".join((self._device_tree["registration"]["root_topic"],"#"))
+    def _avail_msg(self, available):	# availability message, the last will one has no timestamp
+        return msgs.message(timestamp=self._timestamp.timestamp_str() if available else None, timetolive=0, payload={"available":available})
+    def start_mqtt(self, keepalive=60):	# connects to the broker, process() keeps reconnecting if it fails
+        self._new_mqtt(MQTTClient, keepalive)
+        self._sub_topic=self._set_root_topic()
+        self._avail_topic="/".join((self._device_tree["registration"]["root_topic"],"available"))
+        self._mqtt.set_last_will(self._avail_topic, self._avail_msg(False), retain=True, qos=1)
+        self._backoff=self._backoff_min
+        if not self._mqtt_connect():
+            self._offline(None)
             return
+        logger.log(logging.DEBUG,__class__.__name__+".start_mqtt():MQTT Subscribed, Topic:[{}]", self._sub_topic)
+    def _mqtt_connect(self)->bool:	# connects resuming the broker session, True if online
+        c=self._config
         try:
-            topic=None
-            self._device_tree["registration"]["root_topic"]="/".join((self._config.mqtt_path,self.name.decode(b'UTF-8')))
-            topic="/".join((self._device_tree["registration"]["root_topic"],"#"))
-            logger.log(logging.DEBUG,__class__.__name__+".start_mqtt():MQTT Subscribing, Topic:[{}]", topic)
-            self._mqtt.subscribe(topic)
-        except Exception as e:
-            sys.print_exception(e)
-            logger.log(logging.DEBUG,__class__.__name__+".start_mqtt():MQTT Subscribing, Topic:[{}], exception [{}]",topic, e)
-        logger.log(logging.DEBUG,__class__.__name__+".start_mqtt():MQTT Subscribed, Topic:[{}]", topic)
+            if not self._mqtt.connect(clean_session=False):	# the broker has no session, the subscription is renewed
+                logger.log(logging.DEBUG,__class__.__name__+"._mqtt_connect():MQTT Subscribing, Topic:[{}]", self._sub_topic)
+                self._mqtt.subscribe(self._sub_topic)
+            self._mqtt.publish(self._avail_topic, self._avail_msg(True), retain=True)
+        except Exception as e:	# OSError, MQTTException or a malformed CONNACK
+            logger.log(logging.ERROR,__class__.__name__+"._mqtt_connect(broker={}, port={}):MQTT Exception:[{}]", c.mqtt_broker, c.mqtt_port, e)
+            return False
+        self._online=True
+        return True
+    def set_reconnect(self, backoff_min=1000, backoff_max=60000):	# ms, reconnect delay range
+        self._backoff_min=backoff_min
+        self._backoff_max=backoff_max
+        self._backoff=backoff_min
+    def _reconnect(self, sleep):	# tries to reconnect when the backoff is over, returns sleep shortened to the next attempt
+        now=ts.ticks_ms()
+        t=ts.ticks_diff(self._retry_t, now)
+        if t<=0:
+            if self._mqtt_connect():
+                self._reconnected()
+                return sleep
+            self._backoff=min(self._backoff*2, self._backoff_max)
+            t=self._retry_in(now)
+        return t if sleep is None or t<sleep else sleep
+    def _reconnected(self):	# statistics of the outage, shared by _reconnect() and _run_mqtt()
+        self.reconnects+=1
+        self.reconnect_ms=ts.ticks_diff(ts.ticks_ms(), self._lost_t)
+        self._backoff=self._backoff_min
+        logger.log(logging.INFO,__class__.__name__+"._reconnected(): online after {} ms, {} messages lost",self.reconnect_ms, self.lost)
+    def _retry_in(self, now)->int:	# schedules the next attempt in backoff/2 to backoff ms, the jitter spreads the reconnections of many devices
+        t=self._backoff//2+(random.getrandbits(16)*(self._backoff//2)>>16)
+        self._retry_t=ts.ticks_add(now, t)
+        return t
+    async def start_mqtt_async(self, keepalive=0)->bool:	# connects to the broker, run() keeps reconnecting if it fails
+        from MQTT_slim import aio
+        _load_asyncio()
+        self._new_mqtt(aio.MQTTClient, keepalive)
+        self._sub_topic=self._set_root_topic()
+        self._avail_topic="/".join((self._device_tree["registration"]["root_topic"],"available"))
+        self._mqtt.set_last_will(self._avail_topic, self._avail_msg(False), retain=True, qos=1)
+        self._backoff=self._backoff_min
+        if not await self._mqtt_connect_async():
+            self._offline(None)
+            return False
+        logger.log(logging.DEBUG,__class__.__name__+".start_mqtt_async():MQTT Subscribed, Topic:[{}]", self._sub_topic)
+        return True
+    async def _mqtt_connect_async(self)->bool:	# _mqtt_connect() with the MQTT_slim.aio client
+        c=self._config
+        try:
+            if not await self._mqtt.connect(clean_session=False):	# the broker has no session, the subscription is renewed
+                await self._mqtt.subscribe(self._sub_topic)
+            self._mqtt.publish(self._avail_topic, self._avail_msg(True), retain=True)
+            await self._mqtt.drain()
+        except Exception as e:	# OSError, MQTTException or a malformed CONNACK
+            logger.log(logging.ERROR,__class__.__name__+"._mqtt_connect_async(broker={}, port={}):MQTT Exception:[{}]", c.mqtt_broker, c.mqtt_port, e)
+            self._mqtt.close()
+            return False
+        self._online=True
+        return True
+    async def run(self, max_sleep=1000, keepalive=60, ntp_interval=60):	# asyncio version of start_device() and the process() loop
+        # inbound messages, sensor deadlines, keepalive pings and NTP resync run as concurrent tasks,
+        # so a slow broker round trip does not stall the sensor sampling
+        logger.log(logging.DEBUG,__class__.__name__+".run()")
+        _load_asyncio()
+        await self.start_net_async()
+        if not self._config.iot_enabled:	# The device is not enabled, lets run the interactive web prompt
+            return False
+        if not self._timestamp:
+            self._timestamp = ts.timestamp( ntp_server=self._config.ntp_svr )
+        await self.start_mqtt_async(keepalive)	# _run_mqtt() retries if it fails
+        self.register()		# Register de device on the MQTT broker
+        self.available()	# Notify to subscribers that the device is available
+        await asyncio.gather(self._run_mqtt(), self._run_sensors(max_sleep), self._run_keepalive(keepalive), self._run_ntp(ntp_interval))
+    async def _run_mqtt(self):	# reads the inbound messages, reconnects with the process() backoff when the link is lost
+        while True:
+            if self._online:
+                self._rx_task=asyncio.create_task(self._mqtt.listen())
+                try:
+                    await self._rx_task
+                except asyncio.CancelledError:	# stopped by _link_lost()
+                    if self._online:
+                        raise
+                except Exception as e:	# OSError when the broker closes the stream, or a malformed packet
+                    self._offline(e)
+                self._rx_task=None
+                self._mqtt.close()
+            else:
+                t=ts.ticks_diff(self._retry_t, ts.ticks_ms())
+                if t>0:
+                    await asyncio.sleep(t/1000)
+                elif await self._mqtt_connect_async():
+                    self._reconnected()
+                else:
+                    self._backoff=min(self._backoff*2, self._backoff_max)
+                    self._retry_in(ts.ticks_ms())
+    def _link_lost(self, e):	# _offline() from the other tasks, also stops the listen() task on the dead stream
+        self._offline(e)
+        if self._rx_task:
+            self._rx_task.cancel()
+    async def _run_sensors(self, max_sleep):
+        wake=asyncio.Event()
+        self._scheduler.on_wake=wake.set	# Value.push() interrupts the sleep
+        tree=self._device_tree["sensors"]
+        irq=self._irq
+        if irq and hasattr(asyncio, "ThreadSafeFlag"):	# Value.irq() interrupts the sleep
+            irq.flag=asyncio.ThreadSafeFlag()
+            asyncio.create_task(self._run_irq(wake))
+        elif irq and self._irq_poll<max_sleep:
+            max_sleep=self._irq_poll
+        while True:
+            if irq:
+                irq.drain()
+            now=self._scheduler.now()
+            for name, sensor in  tree.items():
+                sensor["object"].process(now)		# sensor drivers housekeeping
+            self._scheduler.run()
+            sleep=self._drain_outbox(self._batch_poll(self._scheduler.sleep_time(max_sleep)))
+            if self._log:
+                self._log.poll()
+            if self._online:
+                try:
+                    await self._mqtt.drain()
+                except OSError as e:
+                    self._link_lost(e)
+            wake.clear()
+            try:
+                await asyncio.wait_for(wake.wait(), sleep/1000)
+            except asyncio.TimeoutError:
+                pass
+    async def _run_irq(self, wake):
+        while True:
+            await self._irq.flag.wait()
+            wake.set()
+    async def _run_keepalive(self, keepalive):	# pings only when the link has been idle, see MQTTClient.check_keepalive()
+        while keepalive:
+            await asyncio.sleep((self._mqtt.ping_in() if self._online else keepalive*500)/1000)
+            if self._online:
+                try:
+                    self._mqtt.check_keepalive()
+                    await self._mqtt.drain()
+                except OSError as e:	# no PINGRESP in time, or the stream failed
+                    self._link_lost(e)
+    async def _run_ntp(self, interval):
+        while interval:
+            await asyncio.sleep(interval)
+            await self._timestamp.ntp_synced_async()	# resyncs only when max_sync_interval has been exceeded, without blocking the other tasks
     def register(self):		# Register the device on the designated MQTT broker, opens  defined publications and subscriptions
         try:
             topic = "/".join((self._config.mqtt_path,"registration")) 
             msg=msgs.message(timestamp=self._timestamp.timestamp_str(), timetolive=0, payload=self._device_tree["registration"])
-            logger.log(logging.DEBUG,__class__.__name__+".register(): topic={}, msg={}",topic, msg)
-            self._mqtt.publish(topic, msg, retain=True, qos=0) # make a retain publication pf registration information
+            if __debug__ and logger.isEnabledFor(logging.DEBUG): logger.log(logging.DEBUG,__class__.__name__+".register(): topic={}, msg={}",topic, msg)
+            self._publish(topic, msg, retain=True) # make a retain publication pf registration information
         except Exception as e:
             sys.print_exception(e)
             logger.log(logging.DEBUG,__class__.__name__+".register():MQTT publishing registration , Exception:[{}]", e)
@@ -345,22 +929,50 @@ class Device:
         try:
             topic = "/".join((self._config.mqtt_path,"device")) 
             msg=msgs.message(timestamp=self._timestamp.timestamp_str(), timetolive=0, payload=self._device_tree["registration"])
-            logger.log(logging.DEBUG,__class__.__name__+".available(): topic={}, msg={}",topic, msg)
-            self._mqtt.publish(topic, msg, retain=False, qos=0) # make a retain publication pf registration information
+            if __debug__ and logger.isEnabledFor(logging.DEBUG): logger.log(logging.DEBUG,__class__.__name__+".available(): topic={}, msg={}",topic, msg)
+            self._publish(topic, msg, retain=False) # make a retain publication pf registration information
         except Exception as e:
             sys.print_exception(e)
             logger.log(logging.DEBUG,__class__.__name__+".available():MQTT publishing registration , Exception:[{}]", e)
     def del_sensor(self, sensor):
-        pass # TODO:
+        path=self._index.val(sensor)	# "sensors/<name>/object"
+        if not path:
+            logger.log(logging.WARNING,__class__.__name__+".del_sensor({}): sensor not found",sensor)
+            return False
+        del self._device_tree["sensors"][path.split("/")[1]]
+        sensor._device=None
+        sensor.set_callback(None)
+        sensor.set_scheduler(None)
+        self._index.rebuild()
+        self._build_routes()
+        return True
     def addsensor(self, path, name, sensor, callback=None):	# name is just a label, [sensor] must be the sensor object, [data] must be a sensorfunction dictionary with values.
         #tree_str=find_path(self._device_tree, path, DIC_MODE )		# in micropython we can't use  eval() function because it only works with global variables
         tree=self._device_tree["sensors"]
         tree[name]={
                 "name":name,
                 "object":sensor,
+                "values":{v._name:v for v in sensor._values},
                 }	
+        self._index.rebuild()	# indexes the sensor and its values
+        self._build_routes()
         if not callback: callback=self._sensor_callback
         sensor.set_callback(callback)
+        sensor.set_scheduler(self._scheduler)
+        sensor._device=self
+        if self._irq:
+            for v in sensor._values:
+                if v._irq is not self._irq:
+                    self._irq_add(v)
+    def _value_added(self, sensor, value):	# Sensor.addvalue() after addsensor(), indexes and routes the new value
+        path=self._index.val(sensor)	# "sensors/<name>/object"
+        if not path:
+            return
+        self._device_tree["sensors"][path.split("/")[1]]["values"][value._name]=value
+        self._index.rebuild()
+        self._build_routes()
+        if self._irq and value._irq is not self._irq:
+            self._irq_add(value)
     #def add_sensor_data(self, sensor, name, data, type=SENSOR_DATA_PULL, pull_freq=60):	# name is just a label, [sensor] must be the sensor object, [data] must be a sensorfunction dictionary with values.
     #	#TODO: ONGOING
     #	sensor_tree=find_val(self._device_tree, sensor, DIC_MODE )
@@ -378,76 +990,391 @@ class Device:
         if self._callback:
             self._callback(event=EVT_Sensor_Push_data, args=(sensor, data) )
         # Publicate event
-        path=find_val(self._device_tree, sensor, IOT_MODE )
-        if path:
-            
-            topic = "/".join((self._device_tree["registration"]["root_topic"],path)) 
+        topic=self._index.topic(sensor)	# precomputed "root_topic/sensors/<name>/object"
+        if topic:
             msg= data.read()	# read the data from sensor 
-            #for i  in range(len(msg)):
-            #	if type(msg[i]) is bytearray: msg[i]=msg[i].decode()	# converts bytearray to str
-            msg=json.dumps({"tst": self._timestamp.timestamp_str(), "pld": msg})
-            logger.log(logging.DEBUG,__class__.__name__+"._sensor_callback(): topic={}, msg={}",topic, msg)
-            self._mqtt.publish(topic, msg, retain=True, qos=0) # make a retain publication pf registration information
-    def process(self)-> int:
-        self._mqtt.check_msg() # process MQTT message queues
+            if self._batch_mode:
+                self._batch_add(topic, data, msg)
+            else:
+                self._publish_reading(topic, msg)
+            if data._irq_t is not None:
+                self._irq_done(data)
+    def _publish_reading(self, topic, msg):
+        if __debug__ and logger.isEnabledFor(logging.DEBUG): logger.log(logging.DEBUG,__class__.__name__+"._sensor_callback(): topic={}, pld={}",topic, msg)
+        box=self._outbox
+        if self._online and (box is None or box.empty()) and hasattr(self._mqtt, "publish_msg"):
+            try:	# encoded straight into the MQTT packet buffer
+                self._mqtt.publish_msg(topic, self._codec, self._stamp(), self._outbox_ttl, msg, retain=True)
+                return
+            except msgs.BufferFull:	# larger than the packet buffer, sent the usual way
+                pass
+            except OSError as e:
+                self._offline(e)
+        msg=self._encode(msg, self._outbox_ttl)
+        self._publish(topic, msg, retain=True, ttl=self._outbox_ttl) # make a retain publication pf registration information
+    def set_irq(self, size=16, poll=20):	# enables Value.irq() with a queue of size posts, process() sleeps at most poll ms
+        self._irq=IrqQueue(size)
+        self._irq_poll=poll
+        for s in self._device_tree["sensors"].values():
+            for v in s["object"]._values:
+                self._irq_add(v)
+    def _irq_add(self, value):
+        value._irq=self._irq
+        value._slot=self._irq.add(value)
+    def _irq_done(self, data):	# measures the interrupt to publish latency
+        t=ts.ticks_diff(ts.ticks_us(), data._irq_t)
+        data._irq_t=None
+        self.irq_events+=1
+        self.irq_latency=t
+        if t>self.irq_latency_max:
+            self.irq_latency_max=t
+    def set_codec(self, codec):	# msgs codec of the sensor messages, announced in the registration
+        self._codec=codec
+        self._device_tree["registration"]["codec"]=codec.name
+        self._index.rebuild()
+        if self._online:
+            self.register()
+    def _stamp(self):	# timestamp in the codec format
+        return self._timestamp.epoch_us() if self._codec.us else self._timestamp.timestamp_str()
+    def _encode(self, payload, ttl=0, t=None)->bytes:	# message of payload in the codec format, stamped now or at t
+        while 1:
+            try:
+                n=self._codec.encode(self._obuf, 0, self._stamp() if t is None else t, ttl, payload)
+                return bytes(memoryview(self._obuf)[:n])
+            except msgs.BufferFull:	# grows the buffer for the larger messages, up to _OBUF_MAX
+                if len(self._obuf)>=_OBUF_MAX:
+                    raise
+                self._obuf=bytearray(min(2*len(self._obuf), _OBUF_MAX))
+    def _publish(self, topic, msg, retain=False, qos=0, ttl=0):	# publishes msg, or queues it in the outbox while offline
+        box=self._outbox
+        if self._online and (box is None or box.empty()):	# queued messages go first, keeps the order
+            try:
+                self._mqtt.publish(topic, msg, retain=retain, qos=qos)
+                return
+            except OSError as e:
+                self._offline(e)
+        if box is None:
+            self.lost+=1
+        else:
+            box.put(topic, msg, qos, retain, ttl)
+    def _offline(self, e):	# marks the connection as lost, process() reconnects after the backoff
+        was=self._online
+        self._online=False	# before logging, the remote log handler must not write to the failed socket
+        now=ts.ticks_ms()
+        self._lost_t=now
+        self._retry_in(now)
+        if was:
+            logger.log(logging.ERROR,__class__.__name__+"._offline(): MQTT connection lost, Exception:[{}]", e)
+    def set_outbox(self, box, drain_rate=20, ttl=0):	# box is an outbox.Outbox, ttl in seconds for the queued sensor readings
+        if not drain_rate>0:
+            raise ValueError("drain_rate must be >0")
+        self._outbox=box
+        self._outbox_ttl=ttl
+        self._drain_rate=drain_rate
+        self._drain_credit=drain_rate*1000
+        self._drain_t=ts.ticks_ms()
+    def _drain_outbox(self, sleep):	# republishes queued messages at drain_rate, returns sleep shortened while some are left
+        box=self._outbox
+        if box is None or not self._online or box.empty():
+            return sleep
+        now=ts.ticks_ms()
+        rate=self._drain_rate
+        self._drain_credit=min(rate*1000, self._drain_credit+ts.ticks_diff(now, self._drain_t)*rate)	# at most 1s of burst
+        self._drain_t=now
+        while self._drain_credit>=1000:
+            m=box.peek()
+            if m is None:
+                return sleep
+            topic, msg, qos, retain=m
+            try:
+                self._mqtt.publish(topic, msg, retain=retain, qos=qos)
+            except OSError as e:
+                self._offline(e)
+                return sleep
+            box.pop()
+            self._drain_credit-=1000
+        t=(1000-self._drain_credit)//rate+1	# ms until the next message is allowed
+        return t if sleep is None or t<sleep else sleep
+    def set_remote_log(self, level=logging.INFO, loggers=("iot", "ts", "msgs", "outbox", "MQTT_slim"), **kw):	# ships the logs to "<root_topic>/log", kw are Logging.MQTTHandler arguments
+        topic="/".join((self._config.mqtt_path, self.name.decode('UTF-8'), "log"))
+        self._log=logging.MQTTHandler(self._log_publish, topic, level=level, **kw)
+        for name in loggers:
+            logging.getLogger(name).addHandler(self._log)
+        return self._log
+    def _log_publish(self, topic, msg)->bool:	# QoS 0 log batch, False instead of queuing or waiting when the link is down or busy
+        box=self._outbox
+        if not self._online or (box is not None and not box.empty()):
+            return False
+        if hasattr(self._mqtt, "inflight") and self._mqtt.inflight():	# QoS 1 and 2 messages waiting for their acks
+            return False
+        try:
+            self._mqtt.publish(topic, msg)
+            return True
+        except OSError as e:
+            self._offline(e)
+            return False
+    def set_rate_limit(self, rate, burst=1, reserve=0):	# readings per second of the whole device, reserve tokens kept for PRIO_CONTROL
+        self._scheduler.bucket=TokenBucket(rate, burst, reserve) if rate else None
+    def throttle_stats(self)->dict:	# {"device"|"<sensor>"|"<sensor>/<value>": (passed, throttled)} of the rate limited levels
+        stats={}
+        b=self._scheduler.bucket
+        if b: stats["device"]=(b.passed, b.throttled)
+        for name, s in self._device_tree["sensors"].items():
+            b=s["object"].bucket
+            if b: stats[name]=(b.passed, b.throttled)
+            for v in s["object"]._values:
+                if v.bucket: stats[name+"/"+v._name]=(v.bucket.passed, v.bucket.throttled)
+        return stats
+    def set_batching(self, mode=BATCH_MERGE, window=100, budget=1024):	# collects the pushes for window ms or budget bytes of readings
+        self.flush_batch()
+        self._batch_mode=mode
+        self._batch_window=window
+        self._batch_budget=budget
+    def _batch_add(self, topic, value, reading):
+        b=self._batch
+        if not b:
+            self._batch_t0=ts.ticks_ms()
+        t=self._stamp()
+        if self._batch_mode==BATCH_BURST:	# encoded now, BATCH_MERGE encodes the merged readings in flush_batch()
+            msg=self._encode(reading, self._outbox_ttl, t)
+            size=len(msg)
+        else:
+            msg=None
+            size=len(value._name)+_MERGE_BYTES
+        old=b.get(id(value))
+        if old:		# the retained reading is superseded, only the last one is published
+            self._batch_bytes-=old[5]
+        b[id(value)]=(topic, value._name, t, reading, msg, size)
+        self._batch_bytes+=size
+        if self._batch_bytes>=self._batch_budget:
+            self.flush_batch()
+    def flush_batch(self):	# publishes the pending pushes
+        b=self._batch
+        if not b:
+            return
+        self._batch={}
+        self._batch_bytes=0
+        if self._batch_mode==BATCH_BURST:	# the usual message of every value
+            frames=[(topic, msg) for topic, name, t, reading, msg, size in b.values()]
+        else:	# one message per sensor topic, "pld" holds the readings by value name
+            topics={}
+            for topic, name, t, reading, msg, size in b.values():
+                if topic in topics:
+                    topics[topic][1][name]=reading
+                else:
+                    topics[topic]=(t, {name: reading})
+            frames=[(topic, self._encode(readings, self._outbox_ttl, t)) for topic, (t, readings) in topics.items()]
+        if __debug__ and logger.isEnabledFor(logging.DEBUG): logger.log(logging.DEBUG,__class__.__name__+".flush_batch(): {} values in {} messages",len(b), len(frames))
+        box=self._outbox
+        if self._online and (box is None or box.empty()):
+            try:
+                self._mqtt.publish_batch(frames, retain=True)
+                return
+            except OSError as e:	# part of the burst may be lost, all of it is queued
+                self._offline(e)
+        if box is None:
+            self.lost+=len(frames)
+            return
+        for topic, msg in frames:
+            box.put(topic, msg, 0, True, self._outbox_ttl)
+    def _batch_poll(self, sleep):	# flushes the batch when its window is over, returns sleep shortened to the window end
+        if self._batch:
+            t=self._batch_window-ts.ticks_diff(ts.ticks_ms(), self._batch_t0)
+            if t<=0:
+                self.flush_batch()
+            elif sleep is None or t<sleep:
+                return t
+        return sleep
+    def process(self, max_sleep=1000)-> int:	# Returns the ms the caller can sleep (up to max_sleep) until the next value is due
+        if self._online:
+            try:
+                self._mqtt.check_msg() # process MQTT message queues
+            except OSError as e:
+                self._offline(e)
         #tree_str=find_path(self._device_tree, "sensors", DIC_MODE ) # in micropython we can't use  eval() function because it only works with global variables
         tree=self._device_tree["sensors"]
-        i=0	# counts the number of sensors process called
-        timestamp=self._timestamp.timestamp_tuple()
+        if self._irq:
+            self._irq.drain()	# pushes posted by the interrupt handlers
+            if max_sleep is None or self._irq_poll<max_sleep:
+                max_sleep=self._irq_poll
+        now=self._scheduler.now()
         for name, sensor in  tree.items():
-            i+=sensor["object"].process(timestamp)		# count  processed values
-        return i
+            sensor["object"].process(now)		# sensor drivers housekeeping
+        self._scheduler.run()	# processes only the due values
+        sleep=self._batch_poll(self._scheduler.sleep_time(max_sleep))
+        if not self._online and self._mqtt:
+            return self._reconnect(sleep)
+        if self._log:
+            self._log.poll()	# ships the buffered log records
+        t=self._mqtt.ping_in() if self._mqtt else None	# wakes up for the keepalive
+        if t is not None and (sleep is None or t<sleep):
+            sleep=t
+        return self._drain_outbox(sleep)
 
 class Sensor:
+    bucket=None		# TokenBucket shared by the values of the sensor, see set_rate_limit()
+    _device=None	# Device the sensor was added to, set by Device.addsensor()
     def __init__(self, callback:Callable[[Value], None]=None):
         self._values=[]	# initializes the values list
         self._callback=callback
-    def addvalue(self, name, get, freq_max=None, freq_min=None, type=None, read=None) -> None:
-        self._values.append(Value(name=name, get=get, freq_max=freq_max, freq_min=freq_min, type=type, read=read , callback=self.values_callback))
+        self._scheduler=None
+    def addvalue(self, name, get, freq_max=None, freq_min=None, type=None, read=None, set=None,
+                 deadband=None, deadband_rel=None, on_change=False, heartbeat=None, window=None, stats=None, typecode="f",
+                 burst=1, priority=None) -> None:
+        value=Value(name=name, get=get, freq_max=freq_max, freq_min=freq_min, type=type, read=read , callback=self.values_callback, set=set,
+                    deadband=deadband, deadband_rel=deadband_rel, on_change=on_change, heartbeat=heartbeat,
+                    window=Window(window, typecode, stats) if window else None, burst=burst, priority=priority)
+        value._sensor=self
+        self._values.append(value)
+        if self._scheduler:
+            self._scheduler.add(value)
+        if self._device:
+            self._device._value_added(self, value)
+    def set_scheduler(self, scheduler:Scheduler):	# registers the values deadlines, set by Device.addsensor()
+        for value in self._values:
+            if self._scheduler: self._scheduler.remove(value)
+            if scheduler: scheduler.add(value)
+        self._scheduler=scheduler
+    def set_rate_limit(self, rate, burst=1, reserve=0):	# readings per second of all the values together, None removes it
+        self.bucket=TokenBucket(rate, burst, reserve) if rate else None
     def values_callback(self, value: Value) -> None:
         #logger.log(logging.DEBUG,__class__.__name__+".values_callback: msg={}",value)
         self._callback(self, value)
     def set_callback(self, callback:Callable[[Value], None]):	# sets the function to call when data is ready to be transmited to Device
         self._callback=callback
-    def process(self, timestamp)->int:	# Called by Device.process() every cicle
-        self._process(timestamp)	# Calls the sensor driver process method
-        #TODO: recovers sensor, produces data, checks push, returns pulls
-        i=0
-        for value in self._values:
-            i+= value.process(timestamp)	# count  processed values
-        return i
+    def process(self, now)->None:	# Called by Device.process() every cicle, now is Scheduler.now(). Values are processed by the Scheduler when due
+        self._process(now)	# Calls the sensor driver process method
+    def message(self, topic, payload)->None:	# Called by the Device dispatcher with a command for this sensor
+        self._message(topic, payload)	# Calls the sensor driver message method
 # this clash define the value or group of values that share frequency and pull/push characteristics 
 # Note, usually get() and read() should return the same values but only get() actually reads from the sensor.
 class Value:
-    def __init__(self, name, get, freq_max=None, freq_min=None, type=None, read=None , callback:Callable[[Value], None]=None):
+    def __init__(self, name, get, freq_max=None, freq_min=None, type=None, read=None , callback:Callable[[Value], None]=None, set=None,
+                 deadband=None, deadband_rel=None, on_change=False, heartbeat=None, window=None, burst=1, priority=None):
         self._name=name			# just a label for the value 
         self._type = type	
         self._read = read		# function to read the allready processed sensor value that should return single value or  a dictionary {"name1":Value1,"name2":value2,..} of values
         self._get = get			# function to get the value from the sensor
+        self._set = set			# function to write a SENSOR_CONTROL value received from the broker
         self._freq_max=freq_max	# max number of gets/callbacks per second allowed
         self._freq_min=freq_min	# minimum number of gets/callbacks per second (in case the sensor could undergo buffer overflow)
         self._callback=callback	# callback funtion for push data
-        self._last_get=(0,0,0,0,0,0,0,0)
+        self._period=int(1000/freq_min) if freq_min else None	# ms between forced gets
+        # Report by exception: a pushed reading is only published if it differs from the last one published
+        self._deadband=deadband			# by more than this absolute amount (numbers)
+        self._deadband_rel=deadband_rel	# by more than this fraction of the last one (numbers)
+        self._on_change=on_change		# at all, the other types always compare this way
+        self._heartbeat=int(heartbeat*1000) if heartbeat else None	# ms after which it is published anyway
+        if self._heartbeat and (self._period is None or self._heartbeat<self._period):
+            self._period=self._heartbeat	# gets it at least once per heartbeat
+        self._sent_v=None	# last reading published
+        self._sent_t=None	# Scheduler.now() when it was published, None to publish the next one
+        self.sent=0			# readings published
+        self.suppressed=0	# readings not published by the reporting policy
+        self._window=window	# Window aggregating the readings, read() returns its result
+        self._irq=None		# IrqQueue of irq()
+        self._slot=0		# slot of the value in it
+        self._irq_t=None	# ts.ticks_us() of the pending interrupt
+        self.bucket=TokenBucket(freq_max, burst) if freq_max else None	# freq_max readings per second, bursts of burst
+        self._prio=priority if priority is not None else PRIO_CONTROL if type and type & SENSOR_CONTROL else PRIO_TELEMETRY
+        self._sensor=None	# Sensor of the value, its bucket is the next level
+        self.throttled=0	# readings delayed by the rate limits
+        self._last=None		# Scheduler.now() of the last get
+        self._due=None		# Scheduler.now() of the next get, None if not scheduled
+        self._sched=None	# Scheduler the value is registered in
         self._flg_read=False
         self._flg_push=False
 
     def get(self):
         return self._get()
     def read(self):
-        return self._read()
-    def process(self, timestamp)->int:	# Cheks if it is time for the value to be pulled or pushed
-        t = ts.difftime(self._last_get, timestamp)
-        if (t and ((1/t)<self._freq_min) or (self._flg_push and (1/t)<self._freq_max)):	# the last value is below the minimum threshold. we must puch a value
-            self._flg_read=False
-            self._last_get=timestamp
+        return self._window.result if self._window else self._read()
+    def sample(self, x)->None:	# adds a sample to the window, for drivers sampling faster than the Scheduler
+        if self._window.add(x):
+            self.push()
+    def set(self, value):
+        return self._set(value)
+    def message(self, topic, payload)->None:	# Called by the Device dispatcher with a new value, writes it and reports the result
+        self.set(payload)
+        self._sent_t=None	# the result is always reported
+        self.push()
+    def irq(self, pin=None)->None:	# Interrupt handler, e.g. pin.irq(handler=value.irq), the push is done by Device.process()
+        self._irq.post(self._slot)
+    def push(self)->None:	# Requests a push of the value, it is processed as soon as freq_max allows
+        self._flg_push=True
+        if self._sched:
+            self._sched.wake(self)
+    def process(self, now)->int:	# Called by the Scheduler when the value is due (freq_min period elapsed or a push allowed by freq_max)
+        self._flg_read=False
+        self._last=now
+        w=self._window
+        if w is None:
+            self.get()
+        elif not w.ready:	# samples the reading, the window is published once complete
             self.get()
-            if self._type & (SENSOR_DATA_PUSH | SENSOR_CONTROL):
+            if not w.add(self._read()):
+                self._flg_push=False
+                self._irq_t=None
+                return 1
+        if self._type & (SENSOR_DATA_PUSH | SENSOR_CONTROL):
+            t=self._wait()
+            if t:	# throttled, published when the Value, Sensor and Device buckets allow it
+                self.throttled+=1
+                self._sched.defer(self, now+t)
+                return 1
+            if self._report(now):
+                self._take()
                 self._callback(self)
-            self.read()
-            self._flg_push=False	# resets push flag if set
-            return 1
-        else:
-            self._flg_push=False	# resets push flag if set
-            return 0
+        if w:
+            w.ready=False
+        self.read()
+        self._flg_push=False	# resets push flag if set
+        self._irq_t=None	# also when the policy held the reading back
+        return 1
+    def _buckets(self):	# Value, Sensor and Device TokenBuckets
+        return (self.bucket, self._sensor.bucket if self._sensor else None, self._sched.bucket if self._sched else None)
+    def _wait(self)->int:	# ms until all the buckets have a token for the value priority
+        t=0
+        for b in self._buckets():
+            if b:
+                w=b.wait(self._prio)
+                if w:
+                    b.throttled+=1
+                    if w>t: t=w
+        return t
+    def _take(self):
+        for b in self._buckets():
+            if b: b.take()
+    def _report(self, now)->bool:	# applies the reporting policy to the current reading, True if it must be published
+        if not (self._deadband or self._deadband_rel or self._on_change):
+            self.sent+=1
+            return True
+        r=self.read()
+        if self._sent_t is None or (self._heartbeat and now-self._sent_t>=self._heartbeat) or self._changed(self._sent_v, r):
+            self._sent_v=_snapshot(r)
+            self._sent_t=now
+            self.sent+=1
+            return True
+        self.suppressed+=1
+        return False
+    def _changed(self, old, new)->bool:	# True if new is outside the deadbands of old, dicts are compared item by item
+        if type(new) is dict:
+            if type(old) is not dict or len(old)!=len(new):
+                return True
+            for k, v in new.items():
+                if k not in old or self._changed(old[k], v):
+                    return True
+            return False
+        if (self._deadband or self._deadband_rel) and type(new) in (int, float) and type(old) in (int, float):
+            d=abs(new-old)
+            return d>(self._deadband or 0) and d>abs(old)*(self._deadband_rel or 0)
+        return new!=old
+
+def _snapshot(r):	# copy of a reading that later changes of the driver buffers can't alter
+    if type(r) is dict:
+        return {k:_snapshot(v) for k, v in r.items()}
+    if type(r) is bytearray or type(r) is list:
+        return type(r)(r)
+    return r
 
 logger.log(logging.DEBUG,"Module [{}] loaded",__name__)
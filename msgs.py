@@ -7,19 +7,365 @@ import Logging as logging
 logger = logging.getLogger(__name__)
 logger.log(logging.DEBUG,"Module [{}] loading",__name__)
 import json
+try:
+	import ustruct as struct
+except ImportError:
+	import struct
 
 MSG_TimeStamp   = "ts"
 MSG_TimeToLive  = "ttl"
 MSG_Payload     = "pld"
 
-def message(timestamp, timetolive, payload):
-	msg={}
-	for k,v in payload.items():
-		if type(v) is bytearray: payload[k]=v.decode()	# converts bytearray to str
+def message(timestamp, timetolive, payload):	# JSON message as str, payload is left untouched
+	return json.dumps({MSG_TimeStamp: timestamp, MSG_TimeToLive: timetolive, MSG_Payload: _plain(payload)})
 
-	msg.update({MSG_TimeStamp: timestamp})
-	msg.update({MSG_TimeToLive: timetolive})
-	msg.update({MSG_Payload: payload})
-	return json.dumps(msg)
+_KEY_TS=b'"ts"'
+_KEY_TTL=b'"ttl"'
+_KEY_PLD=b'"pld"'
+
+def _raw(buf, key, start, end):	# (start, end) of the raw JSON scalar of key in buf[start:end], None if absent
+	i=buf.find(key, start, end)
+	if i<0:
+		return None
+	i=buf.find(b":", i+len(key), end)+1
+	while buf[i] in (32, 9, 10, 13):
+		i+=1
+	if buf[i]==34:		# string
+		return i+1, buf.find(b'"', i+1, end)
+	j=i
+	while j<end and buf[j] not in (44, 125, 32, 9, 10, 13):	# up to , } or blank
+		j+=1
+	return i, j
+
+def _num(b):	# JSON number as an int, floats like 1.7e9 are truncated
+	try:
+		return int(b)
+	except ValueError:
+		return int(float(b.decode()))
+
+class Envelope:
+	''' Received message with its header read and its payload decoded on demand.
+	Only the ``ts`` and ``ttl`` fields are parsed when created, so an expired
+	or duplicated message is dropped without decoding its payload. buf is the
+	message as bytes. ``payload()`` decodes the ``pld`` once and caches it.
+	Messages that do not put ``ts`` and ``ttl`` before ``pld`` are fully
+	decoded.
+	'''
+	def __init__(self, buf, codec=None):
+		self.buf=buf
+		self.ts=None		# timestamp string (int µs with binary codecs), None if absent or null
+		self.ttl=0			# seconds, 0 never expires
+		self._pld=None		# (start, end) of the raw payload
+		self._data=None		# decoded payload
+		self._decoded=False
+		self._codec=None	# binary codec, JSON messages are always recognized by their "{"
+		if codec and codec is not JSON and buf[:1]!=b"{":
+			self._codec=codec
+			self.ts, self.ttl, i=codec.header(buf)
+			self._pld=(i, len(buf))
+			return
+		p=buf.find(_KEY_PLD)
+		if p<0:
+			return
+		r=_raw(buf, _KEY_TS, 0, p)
+		t=_raw(buf, _KEY_TTL, 0, p)
+		if r is None or t is None:	# other layout, decoded the usual way
+			data=json.loads(buf)
+			self.ts=data.get(MSG_TimeStamp)
+			self.ttl=data.get(MSG_TimeToLive) or 0
+			if MSG_Payload in data:
+				self._data=data[MSG_Payload]
+				self._decoded=True
+				self._pld=(0, 0)
+			return
+		if buf[r[0]-1]==34:
+			self.ts=buf[r[0]:r[1]].decode()
+		elif buf[r[0]]!=110:	# int µs
+			self.ts=_num(buf[r[0]:r[1]])
+		if buf[t[0]]!=110:	# not null
+			self.ttl=_num(buf[t[0]:t[1]])
+		i=buf.find(b":", p+len(_KEY_PLD))+1
+		self._pld=(i, buf.rfind(b"}"))	# up to the closing brace of the message
+	def has_payload(self):
+		return self._pld is not None
+	def payload(self):
+		if not self._decoded:
+			if self._codec:
+				self._data=self._codec.payload(self.buf, self._pld[0])
+			else:
+				self._data=json.loads(self.buf[self._pld[0]:self._pld[1]])
+			self._decoded=True
+		return self._data
 	
+# Codecs encode a (ts, ttl, payload) message into a caller provided
+# bytearray, returning the end position, and decode it from a buffer.
+# BufferFull is raised when the buffer is too small, so the caller can
+# retry with a larger one, other errors mean the payload cannot be encoded.
+# The codec name is published in the device registration so the receivers
+# know how to decode its messages.
+class BufferFull(ValueError):
+	pass
+
+def _room(buf, i, n):	# checks that n bytes fit in buf at i
+	if i+n>len(buf):
+		raise BufferFull("buffer full")
+
+def _put(buf, i, data):
+	n=len(data)
+	_room(buf, i, n)
+	buf[i:i+n]=data
+	return i+n
+
+def _plain(v):	# copy of v with the bytearrays of the device tree as strings
+	if type(v) is bytearray:
+		return v.decode()
+	if type(v) is dict:
+		return {k:_plain(x) for k, x in v.items()}
+	return v
+
+# Streaming JSON writer: the values are written straight into buf, with the
+# separators of json.dumps(). None, bool, int, and bytearray or bytes strings
+# without characters to escape, are written without creating any object, str
+# are encoded first and the other values go through json.dumps().
+def _byte(buf, i, b):
+	_room(buf, i, 1)
+	buf[i]=b
+	return i+1
+
+def _int(buf, i, v):	# decimal digits of v, written from the last one
+	if v<0:
+		i=_byte(buf, i, 45)
+		v=-v
+	n=1
+	d=v
+	while d>=10:
+		d//=10
+		n+=1
+	_room(buf, i, n)
+	j=i+n
+	while 1:
+		j-=1
+		buf[j]=48+v%10
+		v//=10
+		if not v:
+			return i+n
+
+def _plain_bytes(s):	# True if s can be quoted as is
+	for c in s:
+		if c<32 or c==34 or c==92:
+			return False
+	return True
+
+def _str(buf, i, s):
+	b=s.encode() if type(s) is str else s
+	if not _plain_bytes(b):
+		return _put(buf, i, json.dumps(s if type(s) is str else bytes(s).decode()).encode())
+	i=_put(buf, _byte(buf, i, 34), b)
+	return _byte(buf, i, 34)
+
+def write_json(buf, i, v)->int:	# JSON encoding of v into buf at i, returns the end
+	t=type(v)
+	if v is None:
+		return _put(buf, i, b"null")
+	if t is bool:
+		return _put(buf, i, b"true" if v else b"false")
+	if t is int:
+		return _int(buf, i, v)
+	if t is str or t is bytearray or t is bytes:
+		return _str(buf, i, v)
+	if t is dict:
+		i=_byte(buf, i, 123)
+		first=True
+		for k, x in v.items():
+			if not first:
+				i=_put(buf, i, b", ")
+			first=False
+			i=_str(buf, i, k if type(k) in (str, bytes, bytearray) else str(k))
+			i=write_json(buf, _put(buf, i, b": "), x)
+		return _byte(buf, i, 125)
+	if t is list or t is tuple:
+		i=_byte(buf, i, 91)
+		for n, x in enumerate(v):
+			if n:
+				i=_put(buf, i, b", ")
+			i=write_json(buf, i, x)
+		return _byte(buf, i, 93)
+	return _put(buf, i, json.dumps(v).encode())	# float and others
+
+class Codec:
+	''' A codec has these methods:
+	``encode(buf, i, ts, ttl, payload)`` writes the message into buf from i and returns its end,
+	``header(buf)`` returns ts, ttl and the payload position of a message,
+	``payload(buf, i)`` decodes the payload at i.
+	'''
+	name=None
+	us=True		# timestamps are int µs since the Unix epoch, otherwise timestamp_str() strings
+
+class Json(Codec):	# the msgs.message() format, with int µs timestamps if us
+	def __init__(self, us=False):
+		self.us=us
+		self.name="json-us" if us else "json"
+	def encode(self, buf, i, ts, ttl, payload)->int:	# ts and ttl first, as Envelope expects them
+		i=write_json(buf, _put(buf, i, b'{"ts": '), ts)
+		i=write_json(buf, _put(buf, i, b', "ttl": '), ttl)
+		i=write_json(buf, _put(buf, i, b', "pld": '), payload)
+		return _byte(buf, i, 125)
+	def header(self, buf):
+		e=Envelope(buf)
+		return e.ts, e.ttl, e._pld[0]
+	def payload(self, buf, i):
+		return Envelope(buf).payload()
+
+# MessagePack subset: nil, bool, int, float (as float32), str, bin, array and map
+# A message is the array [ts, ttl, payload]
+_UINTS=((0xcc, "!BB", 0x100), (0xcd, "!BH", 0x10000), (0xce, "!BI", 0x100000000), (0xcf, "!BQ", None))
+_INTS=((0xd0, "!Bb", -0x80), (0xd1, "!Bh", -0x8000), (0xd2, "!Bi", -0x80000000), (0xd3, "!Bq", None))
+_UNPACK={0xcc: "!B", 0xcd: "!H", 0xce: "!I", 0xcf: "!Q", 0xd0: "!b", 0xd1: "!h", 0xd2: "!i", 0xd3: "!q", 0xca: "!f", 0xcb: "!d"}
+
+def _pack_into(fmt, buf, i, *v):
+	n=struct.calcsize(fmt)
+	_room(buf, i, n)
+	struct.pack_into(fmt, buf, i, *v)
+	return i+n
+
+def _head(buf, i, n, fix, op8, op16):	# header of a str, bin, array or map of n items
+	if fix is not None and n<(32 if fix==0xa0 else 16):
+		return _pack_into("!B", buf, i, fix | n)
+	if op8 is not None and n<0x100:
+		return _pack_into("!BB", buf, i, op8, n)
+	return _pack_into("!BH", buf, i, op16, n)
+
+def pack(buf, i, v)->int:	# MessagePack encoding of v into buf at i, returns the end
+	t=type(v)
+	if v is None:
+		return _pack_into("!B", buf, i, 0xc0)
+	if t is bool:
+		return _pack_into("!B", buf, i, 0xc3 if v else 0xc2)
+	if t is int:
+		if -32<=v<0x80:
+			return _pack_into("!b" if v<0 else "!B", buf, i, v)
+		for op, fmt, lim in _UINTS if v>=0 else _INTS:
+			if lim is None or (v<lim if v>=0 else v>=lim):
+				return _pack_into(fmt, buf, i, op, v)
+	if t is float:
+		return _pack_into("!Bf", buf, i, 0xca, v)
+	if t is str or t is bytearray:
+		s=v.encode() if t is str else v
+		return _put(buf, _head(buf, i, len(s), 0xa0, 0xd9, 0xda), s)
+	if t is bytes:
+		return _put(buf, _head(buf, i, len(v), None, 0xc4, 0xc5), v)
+	if t is list or t is tuple:
+		i=_head(buf, i, len(v), 0x90, None, 0xdc)
+		for x in v:
+			i=pack(buf, i, x)
+		return i
+	if t is dict:
+		i=_head(buf, i, len(v), 0x80, None, 0xde)
+		for k, x in v.items():
+			i=pack(buf, pack(buf, i, k), x)
+		return i
+	raise TypeError(t)
+
+def unpack(buf, i):	# decodes the MessagePack value at i, returns (value, end)
+	b=buf[i]
+	i+=1
+	if b<0x80:
+		return b, i
+	if b>=0xe0:
+		return b-0x100, i
+	if b<0x90:
+		n=b & 0x0f
+		return _map(buf, i, n)
+	if b<0xa0:
+		n=b & 0x0f
+		return _array(buf, i, n)
+	if b<0xc0:
+		n=b & 0x1f
+		return str(buf[i:i+n], "utf-8"), i+n
+	if b==0xc0:
+		return None, i
+	if b==0xc2 or b==0xc3:
+		return b==0xc3, i
+	fmt=_UNPACK.get(b)
+	if fmt:
+		return struct.unpack_from(fmt, buf, i)[0], i+struct.calcsize(fmt)
+	if b==0xd9 or b==0xc4:
+		n=buf[i]
+		i+=1
+	elif b==0xda or b==0xc5 or b==0xdc or b==0xde:
+		n=buf[i]<<8 | buf[i+1]
+		i+=2
+	else:
+		raise ValueError(b)
+	if b==0xdc:
+		return _array(buf, i, n)
+	if b==0xde:
+		return _map(buf, i, n)
+	if b==0xc4 or b==0xc5:
+		return bytes(buf[i:i+n]), i+n
+	return str(buf[i:i+n], "utf-8"), i+n
+
+def _array(buf, i, n):
+	v=[]
+	for _ in range(n):
+		x, i=unpack(buf, i)
+		v.append(x)
+	return v, i
+
+def _map(buf, i, n):
+	v={}
+	for _ in range(n):
+		k, i=unpack(buf, i)
+		v[k], i=unpack(buf, i)
+	return v, i
+
+class MsgPack(Codec):
+	name="msgpack"
+	def encode(self, buf, i, ts, ttl, payload)->int:
+		i=_pack_into("!B", buf, i, 0x93)
+		return pack(buf, pack(buf, pack(buf, i, ts), ttl), payload)
+	def header(self, buf):
+		if buf[0]!=0x93:
+			raise ValueError("not a msgpack message")
+		ts, i=unpack(buf, 1)
+		ttl, i=unpack(buf, i)
+		return ts, ttl, i
+	def payload(self, buf, i):
+		return unpack(buf, i)[0]
+
+class Struct(Codec):	# fixed layout: int64 µs ts, uint32 ttl and the fmt fields of the payload
+	def __init__(self, fmt, names=None):	# fmt without byte order, names are the keys of a dict payload
+		self._fmt="!qI"+fmt
+		self._pfmt="!"+fmt
+		self.names=names
+		self.name="struct:"+fmt+(":"+",".join(names) if names else "")
+		self.size=struct.calcsize(self._fmt)
+	def encode(self, buf, i, ts, ttl, payload)->int:
+		if self.names:
+			payload=[payload[k] for k in self.names]
+		elif type(payload) is not tuple and type(payload) is not list:
+			payload=(payload,)
+		_room(buf, i, self.size)
+		struct.pack_into(self._fmt, buf, i, ts or 0, ttl, *payload)
+		return i+self.size
+	def header(self, buf):
+		ts, ttl=struct.unpack_from("!qI", buf, 0)
+		return ts, ttl, 12
+	def payload(self, buf, i):
+		v=struct.unpack_from(self._pfmt, buf, i)
+		if self.names:
+			return dict(zip(self.names, v))
+		return v[0] if len(v)==1 else v
+
+JSON=Json()
+MSGPACK=MsgPack()
+_codecs={c.name:c for c in (JSON, Json(True), MSGPACK)}
+
+def get_codec(name):	# codec of a registration "codec" name, None if unknown
+	c=_codecs.get(name)
+	if c is None and name and name.startswith("struct:"):
+		f=name.split(":")
+		c=Struct(f[1], f[2].split(",") if len(f)>2 else None)
+	return c
+
 logger.log(logging.DEBUG,"Module [{}] loaded",__name__)
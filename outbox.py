@@ -0,0 +1,174 @@
+##########################################
+## Python module for offline messages   ##
+## store and forward                    ##
+## Written by Juanma					##
+##########################################
+import Logging as logging
+logger = logging.getLogger(__name__)
+logger.log(logging.DEBUG,"Module [{}] loading",__name__)
+import os, time
+try:
+	import ustruct as struct
+except ImportError:
+	import struct
+
+# Spilled record: header + topic + payload
+#	expires	uint32	time.time() after which the message is dropped, 0 never expires
+#	flags	uint8	qos (bits 0-1), retain (bit 2)
+#	topic	uint16	topic length
+#	payload	uint16	payload length
+_HDR="!IBHH"
+_HDR_SIZE=const(9)
+
+def _b(s):
+	return s.encode() if type(s) is str else s
+
+class Outbox:
+	''' Bounded FIFO of outgoing MQTT messages.
+	The oldest messages are kept in a RAM ring of ``ram`` entries, the
+	rest are spilled to append-only segment files ``<path>.<n>`` of up
+	to ``seg_size`` bytes. Appends are buffered and written in blocks of
+	``wblock`` bytes, and a segment file is only deleted once it has been
+	fully drained, so the flash is never rewritten in place. When more
+	than ``max_segs`` segments are needed the oldest one is dropped.
+	Segments left by a previous run are drained first; as the read offset
+	is not persisted, the messages of the segment being drained at reset
+	are sent again, while those still in the RAM ring are lost.
+	'''
+	def __init__(self, path="outbox", ram=32, seg_size=4096, max_segs=16, wblock=512):
+		self._ram=[None]*ram	# ring of (expires, flags, topic, payload)
+		self._head=0			# oldest entry of the ring
+		self._n=0				# entries in the ring
+		self._path=path
+		self._seg_size=seg_size
+		self._max_segs=max_segs
+		self._wblock=wblock
+		self._segs=[]			# [seq, records] of the segment files, oldest first
+		self._wseq=None			# segment appended to
+		self._wsize=0			# bytes already written to it
+		self._wbuf=bytearray()	# appends not written yet
+		self._rf=None			# open file of the oldest segment
+		self._roff=0			# read offset in it
+		self._hdr=bytearray(_HDR_SIZE)
+		self.dropped=0			# records lost because max_segs was exceeded
+		self.expired=0			# records dropped because their ttl expired
+		d, p=self._split()
+		seqs=[]
+		for f in os.listdir(d or "."):
+			if f.startswith(p) and f[len(p):].isdigit():
+				seqs.append(int(f[len(p):]))
+		seqs.sort()
+		self._segs=[[seq, 0] for seq in seqs]	# left by a previous run, record count unknown
+		if seqs:
+			logger.log(logging.INFO,__class__.__name__+".__init__({}): {} segments pending",path, len(seqs))
+	def _split(self):	# directory and file name prefix of the segments
+		i=self._path.rfind("/")
+		return self._path[:i] if i>0 else "/" if i==0 else "", self._path[i+1:]+"."
+	def _file(self, seq):
+		return "{}.{}".format(self._path, seq)
+	def empty(self):
+		return not self._n and not self._segs
+	def __len__(self):	# messages queued, segments left by a previous run count as empty
+		return self._n+sum(s[1] for s in self._segs)
+	def put(self, topic, payload, qos=0, retain=False, ttl=0):	# ttl in seconds, 0 never expires
+		rec=(int(time.time())+ttl if ttl else 0, qos | retain << 2, topic, payload)
+		if self._segs or self._n==len(self._ram):	# spilling, keeps the order
+			self._spill(rec)
+		else:
+			self._ram[(self._head+self._n)%len(self._ram)]=rec
+			self._n+=1
+	def peek(self):		# oldest message not expired, as (topic, payload, qos, retain), None if empty
+		while 1:
+			if not self._n and not self._refill():
+				return None
+			expires, flags, topic, payload=self._ram[self._head]
+			if not expires or expires>time.time():
+				return topic, payload, flags & 3, bool(flags & 4)
+			self.expired+=1
+			self.pop()
+	def pop(self):		# removes the message returned by peek()
+		if self._n:
+			self._ram[self._head]=None
+			self._head=(self._head+1)%len(self._ram)
+			self._n-=1
+	def _spill(self, rec):
+		expires, flags, topic, payload=rec
+		topic=_b(topic)
+		payload=_b(payload)
+		size=_HDR_SIZE+len(topic)+len(payload)
+		if self._wseq is None or self._wsize+len(self._wbuf)+size>self._seg_size:
+			self._flush()
+			self._wseq=self._segs[-1][0]+1 if self._segs else 0
+			self._wsize=0
+			self._segs.append([self._wseq, 0])
+			if len(self._segs)>self._max_segs:
+				self._drop()
+		self._wbuf+=struct.pack(_HDR, expires, flags, len(topic), len(payload))
+		self._wbuf+=topic
+		self._wbuf+=payload
+		self._segs[-1][1]+=1
+		if len(self._wbuf)>=self._wblock:
+			self._flush()
+	def _flush(self):	# writes the buffered appends to the current segment
+		if not self._wbuf:
+			return
+		f=open(self._file(self._wseq), "ab")
+		f.write(self._wbuf)
+		f.close()
+		self._wsize+=len(self._wbuf)
+		self._wbuf=bytearray()
+		if self._rf and self._segs[0][0]==self._wseq:	# the reader reopens it to see the new data
+			self._rf.close()
+			self._rf=None
+	def _drop(self):	# deletes the oldest segment
+		seq, n=self._segs.pop(0)
+		if self._rf:
+			self._rf.close()
+			self._rf=None
+		self._roff=0
+		self.dropped+=n
+		self._remove(seq)
+		logger.log(logging.WARNING,__class__.__name__+"._drop(): segment {} dropped, {} records",seq, n)
+	def _remove(self, seq):
+		try:
+			os.remove(self._file(seq))
+		except OSError:		# never flushed
+			pass
+	def _refill(self):	# moves the oldest spilled record to the RAM ring
+		while self._segs:
+			seq=self._segs[0][0]
+			if seq==self._wseq:
+				self._flush()
+			rec=self._read(seq)
+			if rec:
+				self._ram[self._head]=rec
+				self._n=1
+				if self._segs[0][1]:
+					self._segs[0][1]-=1
+				return True
+			if self._rf:	# segment drained
+				self._rf.close()
+				self._rf=None
+			self._roff=0
+			self._segs.pop(0)
+			self._remove(seq)
+			if seq==self._wseq:
+				self._wseq=None
+		return False
+	def _read(self, seq):	# next record of the oldest segment, None at its end
+		if not self._rf:
+			try:
+				self._rf=open(self._file(seq), "rb")
+			except OSError:
+				return None
+			self._rf.seek(self._roff)
+		f=self._rf
+		if f.readinto(self._hdr)!=_HDR_SIZE:
+			return None
+		expires, flags, ntopic, npayload=struct.unpack(_HDR, self._hdr)
+		topic=f.read(ntopic)
+		payload=f.read(npayload)
+		self._roff+=_HDR_SIZE+ntopic+npayload
+		return expires, flags, topic, payload
+
+logger.log(logging.DEBUG,"Module [{}] loaded",__name__)
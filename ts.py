@@ -8,6 +8,24 @@ logger = logging.getLogger(__name__)
 logger.log(logging.DEBUG,"Module [{}] loading",__name__)
 import sys, network, machine, time, ntptime
 
+# Integer monotonic ticks, wrap around every TICKS_PERIOD so they always stay small ints (no allocation)
+# Always compare them with ticks_diff(), never with < or -
+try:
+	from time import ticks_ms, ticks_us, ticks_diff, ticks_add
+except ImportError:		# ports without ticks_*() (CPython), emulates MicroPython 30 bit ticks
+	def ticks_ms():
+		return int(time.monotonic()*1000) & 0x3fffffff
+	def ticks_us():
+		return int(time.monotonic()*1000000) & 0x3fffffff
+	def ticks_add(ticks, delta):
+		return (ticks+delta) & 0x3fffffff
+	def ticks_diff(ticks1, ticks2):		# signed ticks1-ticks2, valid while the distance is below TICKS_PERIOD/2
+		return ((ticks1-ticks2+0x20000000) & 0x3fffffff) - 0x20000000
+TICKS_PERIOD=const(0x40000000)
+_ANCHOR_MAX=const(0x10000000)	# ms, the wall clock anchor is refreshed before ticks_diff() could overflow
+UNIX_OFFSET=946684800 if time.gmtime(0)[0]==2000 else 0	# secs from 1970 to the time.time() epoch, ports count from 2000 or 1970
+_NTP_DELTA=2208988800+UNIX_OFFSET	# secs from the NTP epoch (1900) to the time.time() epoch
+
 class timestamp:
 	# This attributes are global to the class
 	main_instance=None
@@ -16,6 +34,9 @@ class timestamp:
 	max_sync_interval=None
 	ntp_server=None
 	deltatime=0
+	anchor_ticks=0		# ticks_ms() when the wall clock anchor was taken
+	anchor_secs=0		# time.time() at anchor_ticks
+	anchor_ms=0			# subsecond ms at anchor_ticks
 	
 	def __init__(self, ntp_server = None, max_sync_interval = 3600, deltatime = time.mktime((2020, 1, 1, 0, 0, 0, 0, 0)), time_offset=0):
 		if self.main_instance == None:
@@ -24,6 +45,8 @@ class timestamp:
 			self.max_sync_interval=max_sync_interval
 			self.deltatime = deltatime + time_offset	# All float dates are starting from this date. to increase resolution because we only have 32 bits and it encodes up to microsecconds
 														# do not forget to add this value to get correct gmt date
+			self.anchor()
+			logging.setClock(self)	# log records are timed from ticks with this anchor
 			self.ntp_sync(ntp_server )
 		
 	def ntp_sync(self, ntp_server = None ):
@@ -47,14 +70,86 @@ class timestamp:
 			return False
 		self.synced = True    
 		self.lastsync = time.time()     # Timestamp of lst sinchronization, secconds is enough resolution
+		self.anchor()	# the wall clock has changed
 		return True
 
+	def anchor(self):	# maps the current ticks to the wall clock. Called on NTP sync, so converting ticks does not read the RTC
+		dt=machine.RTC().datetime()
+		t=ticks_ms()
+		self.anchor_secs=time.mktime(dt2lt(dt))
+		self.anchor_ms=dt[7]//1000
+		self.anchor_ticks=t
+
+	def ticks(self):	# ms monotonic ticks, one integer read to time events
+		return ticks_ms()
+
+	def elapsed(self, ticks1, ticks2=None):	# ms from ticks1 to ticks2 (now if not given), wrap around safe
+		if ticks2 is None: ticks2=ticks_ms()
+		return ticks_diff(ticks2, ticks1)
+
+	def epoch_ms(self, ticks):	# returns (secs, ms) wall clock of ticks, secs in time.time() epoch
+		d=ticks_diff(ticks, self.anchor_ticks)
+		if d>_ANCHOR_MAX or d<-_ANCHOR_MAX:	# long without NTP sync, refresh the anchor before the ticks wrap around
+			self.anchor()
+			d=ticks_diff(ticks, self.anchor_ticks)
+		d+=self.anchor_ms
+		return self.anchor_secs+d//1000, d%1000
+
+	def epoch_us(self, ticks=None):	# integer µs wall clock of ticks (now if not given), since the Unix epoch as sent in the messages
+		if ticks is None: ticks=ticks_ms()
+		secs, ms=self.epoch_ms(ticks)
+		return (secs+UNIX_OFFSET)*1000000+ms*1000
+
+	def datetime(self, ticks):	# machine.RTC().datetime() format of ticks, computed from the anchor
+		secs, ms=self.epoch_ms(ticks)
+		dt=lt2dt(time.localtime(secs))
+		return dt[:7]+(ms*1000,)
+
 	def ntp_synced(self):
 		if not self.synced or time.time() - self.lastsync > self.max_sync_interval:     # We have exceded the time interval between synchronizations
 			self.synced = False
 			return self.ntp_sync()
 		else:
 			return self.synced
+
+	async def ntp_synced_async(self, timeout=1000):	# ntp_synced() polling the NTP reply for up to timeout ms, so the other asyncio tasks keep running
+		if self.synced and time.time() - self.lastsync <= self.max_sync_interval:
+			return True
+		self.synced = False
+		try:
+			import asyncio
+		except ImportError:
+			import uasyncio as asyncio
+		import socket, struct
+		server = self.ntp_server or ntptime.host
+		try:
+			addr = socket.getaddrinfo(server, 123)[0][-1]
+			s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			try:
+				s.setblocking(False)
+				q = bytearray(48)
+				q[0] = 0x1B		# version 3, client
+				s.sendto(q, addr)
+				t0 = ticks_ms()
+				while True:
+					try:
+						msg = s.recv(48)
+						break
+					except OSError:		# no reply yet
+						if ticks_diff(ticks_ms(), t0) >= timeout:
+							raise
+						await asyncio.sleep(0.02)
+			finally:
+				s.close()
+			tm = time.gmtime(struct.unpack("!I", msg[40:44])[0] - _NTP_DELTA)	# same as ntptime.settime()
+			machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+		except Exception as e:
+			logger.log(logging.ERROR,__class__.__name__+".ntp_synced_async({}): Sync error: {}", server, e)
+			return False
+		self.synced = True
+		self.lastsync = time.time()
+		self.anchor()	# the wall clock has changed
+		return True
 		
 	def timestamp(self):
 		return time.time() 
@@ -107,6 +202,15 @@ def dt2lt(dt):
 	if not dt: dt=(0,0,0,0,0,0,0,0)
 	return (dt[0],dt[1],dt[2],dt[4],dt[5],dt[6],dt[3],0)  # convert from time.localtime() fromat to machine.RTC().datetime() fromat (yearday is not calculated)
 
+def str2secs(s):
+	'''Converts a timestamp.timestamp_str() "YYYY-MM-DDTHH:MM:SS.ffffff" 
+		string to time.time() seconds, None if it is not in that format
+		'''
+	try:
+		return time.mktime((int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]), 0, 0))
+	except (ValueError, TypeError, OverflowError):
+		return None
+
 def difftime( t1, t2):
 	'''Calculates the time diference between t1 and t2 assuming t1 is older than t2
 		t1 and t2 use machine.RTC.datetime() format.